@@ -11,8 +11,6 @@ from flask_bootstrap import Bootstrap
 from flask_moment import Moment
 from flask_babel import Babel, lazy_gettext as _l
 from elasticsearch import Elasticsearch
-from redis import Redis
-import rq
 
 
 
@@ -41,10 +39,35 @@ def create_app(config_class=Config):
     babel.init_app(app)
     app.elasticsearch = Elasticsearch([app.config['ELASTICSEARCH_URL']]) \
         if app.config['ELASTICSEARCH_URL'] else None
-
-    app.redis = Redis.from_url(app.config['REDIS_URL'])
-    app.task_queue = rq.Queue('microblog-tasks', connection=app.redis)
-
+    from app1.search import create_backend
+    app.search = create_backend(app)
+
+    # redis commands are timed per request by the instrumentation
+    from app1.instrumentation import TimedRedis
+    app.redis = TimedRedis.from_url(app.config['REDIS_URL']) \
+        if app.config['REDIS_URL'] else None
+    # background jobs are routed to these queues by app1.jobs
+    from app1.jobs import create_queues
+    app.task_queues = create_queues(app)
+    from app1.cache import LRUCache, TieredCache
+    app.translation_cache = LRUCache(app.config['TRANSLATION_CACHE_SIZE'])
+    from app1 import fragments
+    app.fragments = fragments.create_backend(app)
+    app.token_cache = TieredCache(app.redis, 'token',
+                                  app.config['TOKEN_CACHE_SIZE'])
+    app.user_cache = TieredCache(app.redis, 'user',
+                                 app.config['USER_CACHE_SIZE'],
+                                 app.config['USER_CACHE_TTL'])
+    from app1.email import MailSender
+    app.mail_sender = MailSender(app)
+    from app1.passwords import HashingPool
+    app.password_pool = HashingPool(app)
+
+
+    from app1 import instrumentation
+    instrumentation.init_app(app)
+    from app1 import http_cache
+    http_cache.init_app(app)
 
     from app1.errors import bp as errors_bp
     app.register_blueprint(errors_bp)
@@ -1,8 +1,97 @@
-# alternative way of logging in for users that are not web browsers
+# authentication of the api: basic auth (username and password) to get a
+# token, bearer tokens for everything else. Tokens are resolved to user ids
+# through the tiered token cache, so most authenticated calls never touch
+# the database, committed revocations and replaced tokens are dropped from
+# every tier of it
+from datetime import datetime
+from functools import wraps
+from time import time
+from flask import g, request, current_app
+from app1 import db
+from app1.api.errors import error_response
+from app1.models import User
 
+_EPOCH = datetime(1970, 1, 1)
 
-def get_token():
-    pass
 
-def revoke_token():
-    pass
\ No newline at end of file
+def user_id_for_token(token):
+    # the cache keeps [user id, expiration] of the valid tokens, redis keeps
+    # them only as long as the token is valid
+    def load():
+        user = User.check_token(token)
+        if user is None:
+            return None, None
+        expiration = (user.token_expiration - _EPOCH).total_seconds()
+        return [user.id, expiration], expiration - time()
+
+    entry = current_app.token_cache.get(token, load)
+    if entry is None or entry[1] <= time():
+        return None
+    return entry[0]
+
+
+# tokens that were replaced or had their expiration changed are collected
+# after the flush and dropped from the caches once the commit went through
+def after_flush(session, flush_context):
+    tokens = session.info.setdefault('revoked_tokens', set())
+    for user in session.dirty:
+        if not isinstance(user, User):
+            continue
+        state = db.inspect(user)
+        token = state.attrs.token.history
+        if token.has_changes() or \
+                state.attrs.token_expiration.history.has_changes():
+            tokens.update(t for t in token.sum() if t)
+
+
+def after_commit(session):
+    tokens = session.info.pop('revoked_tokens', None)
+    if tokens:
+        current_app.token_cache.invalidate(sorted(tokens))
+
+
+def after_rollback(session):
+    session.info.pop('revoked_tokens', None)
+
+
+db.event.listen(db.session, 'after_flush', after_flush)
+db.event.listen(db.session, 'after_commit', after_commit)
+db.event.listen(db.session, 'after_rollback', after_rollback)
+
+
+def current_api_user():
+    # loaded on first use, endpoints that only need the id never query it
+    if g.get('api_user') is None and g.get('api_user_id') is not None:
+        g.api_user = User.query.get(g.api_user_id)
+    return g.get('api_user')
+
+
+def basic_auth_required(f):
+    @wraps(f)
+    def decorated(*args, **kwargs):
+        auth = request.authorization
+        user = User.query.filter_by(username=auth.username).first() \
+            if auth and auth.username else None
+        if user is None or not user.check_password(auth.password or ''):
+            response = error_response(401)
+            response.headers['WWW-Authenticate'] = \
+                'Basic realm="Authentication Required"'
+            return response
+        g.api_user, g.api_user_id = user, user.id
+        return f(*args, **kwargs)
+    return decorated
+
+
+def token_auth_required(f):
+    @wraps(f)
+    def decorated(*args, **kwargs):
+        scheme, _, token = request.headers.get('Authorization', '').partition(' ')
+        user_id = user_id_for_token(token.strip()) \
+            if scheme.lower() == 'bearer' and token.strip() else None
+        if user_id is None:
+            response = error_response(401)
+            response.headers['WWW-Authenticate'] = 'Bearer'
+            return response
+        g.api_user, g.api_user_id = None, user_id
+        return f(*args, **kwargs)
+    return decorated
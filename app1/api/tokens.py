@@ -0,0 +1,25 @@
+# alternative way of logging in for users that are not web browsers
+from flask import jsonify, current_app
+from app1 import db
+from app1.api import bp
+from app1.api.auth import basic_auth_required, token_auth_required, \
+    current_api_user
+
+
+@bp.route('/tokens', methods=['POST'])
+@basic_auth_required
+def get_token():
+    token = current_api_user().get_token(
+        current_app.config['TOKEN_EXPIRES_IN'])
+    db.session.commit()
+    return jsonify({'token': token})
+
+
+@bp.route('/tokens', methods=['DELETE'])
+@token_auth_required
+def revoke_token():
+    # the session listeners in auth drop the token from every cache tier
+    # once the commit went through
+    current_api_user().revoke_token()
+    db.session.commit()
+    return '', 204
@@ -1,24 +1,88 @@
+import json
+from flask import request, url_for, current_app, Response
 from app1.api import bp
+from app1.api.auth import token_auth_required
+from app1.http_cache import not_modified
+from app1.models import User, followers
+from app1.pagination import paginate
+
+
+def json_response(payload):
+    # compact json straight from the stdlib encoder, without the indentation
+    # and the key sorting of jsonify
+    return Response(json.dumps(payload, separators=(',', ':')),
+                    mimetype='application/json')
+
+
+def _validators(user):
+    # everything to_dict() shows of a user
+    return (user.id, user.updated_at, user.last_seen, user.post_count,
+            user.follower_count, user.follows_count)
+
+
+def users_collection(query, id_column, endpoint, **kwargs):
+    # one query for the page, the counters are columns of the users and the
+    # links are built from the collection url. The page is validated by what
+    # it shows, so only the serialization is saved by a 304
+    per_page = max(1, min(request.args.get('per_page', current_app.config[
+        'USERS_PER_PAGE'], type=int), 100))
+    cursor = request.args.get('cursor')
+    page = paginate(query, id_column, per_page, cursor,
+                    key=lambda user: (user.id,), descending=False)
+    response = not_modified(request.full_path, page.next_cursor,
+                            page.prev_cursor,
+                            *[_validators(user) for user in page.items])
+    if response is not None:
+        return response
+    users_url = url_for('api.get_users')
+    return json_response({
+        'items': [user.to_dict(users_url=users_url) for user in page.items],
+        '_meta': {'per_page': per_page},
+        '_links': {
+            'self': url_for(endpoint, cursor=cursor, per_page=per_page,
+                            **kwargs),
+            'next': url_for(endpoint, cursor=page.next_cursor,
+                            per_page=per_page, **kwargs)
+            if page.next_cursor else None,
+            'prev': url_for(endpoint, cursor=page.prev_cursor,
+                            per_page=per_page, **kwargs)
+            if page.prev_cursor else None
+        }
+    })
 
 
 @bp.route('/users/<int:id>', methods=['GET'])
+@token_auth_required
 def get_user(id):
-    pass
+    user = User.query.get_or_404(id)
+    response = not_modified(*_validators(user))
+    if response is not None:
+        return response
+    return json_response(user.to_dict())
 
 
 @bp.route('/users', methods=['GET'])
+@token_auth_required
 def get_users():
-    pass
+    return users_collection(User.query, User.id, 'api.get_users')
 
 
 @bp.route('/users/<int:id>/followers', methods=['GET'])
+@token_auth_required
 def get_followers(id):
-    pass
+    user = User.query.get_or_404(id)
+    # ordered by the column of the followers index
+    return users_collection(user.followers, followers.c.follower_id,
+                            'api.get_followers', id=id)
 
 
 @bp.route('/users/<int:id>/followed', methods=['GET'])
+@token_auth_required
 def get_follows(id):
-    pass
+    user = User.query.get_or_404(id)
+    # ordered by the column of the followers primary key
+    return users_collection(user.follows, followers.c.followed_id,
+                            'api.get_follows', id=id)
 
 
 @bp.route('/users', methods=['POST'])
@@ -28,4 +92,4 @@ def create_user():
 
 @bp.route('/users/<int:id>', methods=['PUT'])
 def update_user(id):
-    pass
\ No newline at end of file
+    pass
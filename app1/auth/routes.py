@@ -21,6 +21,8 @@ def login():
             flash(_('Invalid username or password'))
             return redirect(url_for('auth.login'))
         login_user(user, remember=form.remember_me.data)
+        # saves the password hash if check_password upgraded it
+        db.session.commit()
         next_page = request.args.get('next')
 
         if not next_page or url_parse(next_page).netloc != '':
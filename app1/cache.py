@@ -0,0 +1,147 @@
+# small in-process cache, used as the first tier in front of redis
+import json
+from collections import OrderedDict
+from threading import Lock, Thread
+from time import time, sleep
+import redis
+from flask import current_app
+
+
+class LRUCache(object):
+    # keeps at most maxsize entries, dropping the least recently used ones,
+    # entries older than ttl seconds (if given) are treated as missing
+    def __init__(self, maxsize, ttl=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.lock = Lock()
+        self.entries = OrderedDict()
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            value, expires = entry
+            if expires is not None and expires <= time():
+                del self.entries[key]
+                return None
+            self.entries.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        if self.maxsize <= 0:
+            return
+        expires = time() + self.ttl if self.ttl else None
+        with self.lock:
+            self.entries[key] = (value, expires)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+
+    def delete(self, key):
+        with self.lock:
+            self.entries.pop(key, None)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def __len__(self):
+        return len(self.entries)
+
+
+class TieredCache(object):
+    # values looked up in an in-process LRU, then in redis, then loaded from
+    # the database. Invalidations delete the redis keys and are published on
+    # a channel, every process evicts them from its own LRU when it hears
+    # about them; while not subscribed, and always without redis, the local
+    # tier is bypassed
+    def __init__(self, client, name, maxsize, ttl=None):
+        self.redis = client
+        self.name = name
+        self.local = LRUCache(maxsize, ttl)
+        self.lock = Lock()
+        # bumped on every eviction, a lookup that raced with one is not
+        # stored in the local tier
+        self.generation = 0
+        # without redis no process hears about the invalidations of the others,
+        # so the local tier is never used
+        self.listening = False
+        self.listener = None
+
+    def _key(self, key):
+        return '{}:{}'.format(self.name, key)
+
+    def _listen(self):
+        while True:
+            try:
+                pubsub = self.redis.pubsub(ignore_subscribe_messages=True)
+                pubsub.subscribe(self._key('invalidate'))
+                self.listening = True
+                while True:
+                    message = pubsub.get_message(timeout=1.0)
+                    if message is not None:
+                        self._evict([message['data'].decode('utf-8')])
+            except redis.exceptions.RedisError:
+                # invalidations may be missed while disconnected
+                self.listening = False
+                with self.lock:
+                    self.generation += 1
+                    self.local.clear()
+                sleep(1)
+
+    def _evict(self, keys):
+        with self.lock:
+            self.generation += 1
+            for key in keys:
+                self.local.delete(key)
+
+    def get(self, key, load):
+        # load() returns the json serializable value and for how many seconds
+        # redis may keep it, or (None, None) when there is nothing to cache
+        if self.redis is not None and self.listener is None:
+            with self.lock:
+                if self.listener is None:
+                    self.listener = Thread(target=self._listen, daemon=True)
+                    self.listener.start()
+        if self.listening:
+            value = self.local.get(key)
+            if value is not None:
+                return value
+        generation = self.generation
+        value = None
+        if self.redis is not None:
+            try:
+                raw = self.redis.get(self._key(key))
+                if raw is not None:
+                    value = json.loads(raw.decode('utf-8'))
+            except redis.exceptions.RedisError:
+                pass
+        if value is None:
+            value, seconds = load()
+            if value is None:
+                return None
+            if self.redis is not None:
+                try:
+                    self.redis.setex(self._key(key), max(1, int(seconds)),
+                                     json.dumps(value))
+                except redis.exceptions.RedisError:
+                    pass
+        with self.lock:
+            if self.listening and generation == self.generation:
+                self.local.set(key, value)
+        return value
+
+    def invalidate(self, keys):
+        keys = [str(key) for key in keys]
+        self._evict(keys)
+        if self.redis is not None and keys:
+            try:
+                pipe = self.redis.pipeline()
+                pipe.delete(*[self._key(key) for key in keys])
+                for key in keys:
+                    pipe.publish(self._key('invalidate'), key)
+                pipe.execute()
+            except redis.exceptions.RedisError:
+                current_app.logger.error('Could not invalidate %s cache entries',
+                                         self.name)
@@ -39,4 +39,141 @@ def register(app):
         if os.system(
                 'pybabel init -i messages.pot -d app1/translations -l ' + lang):
             raise RuntimeError('init command failed')
-        os.remove('messages.pot')
\ No newline at end of file
+        os.remove('messages.pot')
+
+
+    @app.cli.group()
+    def timeline():
+        """Home timeline commands."""
+        pass
+
+
+    @timeline.command()
+    def rebuild():
+        """Rebuild the materialized home timelines of all users."""
+        from app1.timeline import rebuild_all
+        click.echo('Rebuilt {} timelines'.format(rebuild_all()))
+
+
+
+    @app.cli.group()
+    def users():
+        """User maintenance commands."""
+        pass
+
+
+    @users.command('flush-last-seen')
+    def flush_last_seen():
+        """Write the recorded user activity to the database."""
+        from app1 import last_seen
+        click.echo('Updated last_seen of {} users'.format(
+            last_seen.flush_last_seen()))
+
+
+
+    @app.cli.group()
+    def search():
+        """Search index commands."""
+        pass
+
+
+    @search.command()
+    @click.option('--batch-size', default=500, help='Posts per bulk request.')
+    @click.option('--workers', default=4, help='Parallel bulk requests.')
+    @click.option('--start-id', default=0,
+                  help='Resume after this post id.')
+    def reindex(batch_size, workers, start_id):
+        """Rebuild the search index of all posts."""
+        from time import time
+        from app1.models import Post
+        if not app.search:
+            raise click.ClickException('No search backend is configured')
+        started = time()
+
+        def progress(indexed, last_id):
+            click.echo('Indexed {} posts up to id {} ({:.0f} docs/sec)'.format(
+                indexed, last_id, indexed / max(time() - started, 1e-6)))
+
+        try:
+            Post.reindex(batch_size=batch_size, workers=workers,
+                         start_id=start_id, progress=progress)
+        except KeyboardInterrupt:
+            click.echo('Interrupted, continue with --start-id set to the '
+                       'last id reported above')
+
+
+    @app.cli.group()
+    def posts():
+        """Post maintenance commands."""
+        pass
+
+
+    @posts.command('detect-language')
+    @click.option('--batch-size', default=1000, help='Posts per batch.')
+    @click.option('--processes', type=int,
+                  help='Detection processes, one per CPU by default.')
+    @click.option('--start-id', default=0,
+                  help='Resume after this post id.')
+    def detect_language(batch_size, processes, start_id):
+        """Detect the language of the posts that do not have one."""
+        from time import time
+        from app1.language import backfill
+        started = time()
+
+        def progress(done, last_id):
+            click.echo('Detected {} posts up to id {} ({:.0f} posts/sec)'.format(
+                done, last_id, done / max(time() - started, 1e-6)))
+
+        try:
+            backfill(batch_size=batch_size, processes=processes,
+                     start_id=start_id, progress=progress)
+        except KeyboardInterrupt:
+            click.echo('Interrupted, continue with --start-id set to the '
+                       'last id reported above')
+
+
+    @app.cli.group()
+    def tasks():
+        """Background job commands."""
+        pass
+
+
+    @tasks.command()
+    @click.option('--processes', type=int,
+                  help='Worker processes, one per CPU by default.')
+    @click.option('--queue', 'queues', multiple=True,
+                  help='Only take jobs from this queue, all by default.')
+    @click.option('--burst', is_flag=True,
+                  help='Exit once the queues are empty.')
+    def worker(processes, queues, burst):
+        """Start a pool of workers for the background job queues."""
+        from multiprocessing import Process, cpu_count
+        from app1.jobs import work
+        if not app.config['REDIS_URL']:
+            raise click.ClickException('REDIS_URL is not configured')
+        # queue priority comes from the configuration, not the options
+        queues = [name for name in app.config['TASK_QUEUES']
+                  if not queues or name in queues]
+        workers = [Process(target=work, args=(
+            app.config['REDIS_URL'], queues, app.config['TASK_CONCURRENCY'],
+            app.config['TASK_LEASE'], burst))
+            for _ in range(processes or cpu_count())]
+        for process in workers:
+            process.start()
+        click.echo('Started {} workers on {}'.format(len(workers),
+                                                     ', '.join(queues)))
+        try:
+            for process in workers:
+                process.join()
+        except KeyboardInterrupt:
+            # the workers got the interrupt as well and finish their jobs
+            for process in workers:
+                process.join()
+
+
+    @users.command('repair-counters')
+    def repair_counters():
+        """Recompute the post, follower and message counters of all users."""
+        from app1.models import User
+        User.repair_counters()
+        click.echo('Counters repaired')
@@ -1,15 +1,109 @@
 from flask_mail import Message
 from app1 import mail
 from flask import current_app
-# package to allow asynchronous tasking in the app 
-# to put the email sending task in the separate background thread
-from threading import Thread
+# outgoing mail is handed to a fixed pool of sender threads through a bounded
+# queue, instead of a new thread and smtp connection per message
+import queue
+import smtplib
+from threading import Lock, Thread
+from time import perf_counter, sleep
 
 
+class MailSender(object):
+    # each sender thread keeps its smtp connection open while there are
+    # messages in the queue and closes it after MAIL_IDLE_TIMEOUT seconds
+    # without any. A full queue makes the callers wait up to
+    # MAIL_QUEUE_TIMEOUT seconds for room, after that the message is dropped
+    def __init__(self, app):
+        self.app = app
+        self.queue = queue.Queue(app.config['MAIL_QUEUE_SIZE'])
+        self.lock = Lock()
+        self.workers = []
 
-def send_async_email(app, msg):
-    with app.app_context():
-        mail.send(msg)
+    def _start(self):
+        with self.lock:
+            while len(self.workers) < self.app.config['MAIL_WORKERS']:
+                worker = Thread(target=self._run, daemon=True)
+                worker.start()
+                self.workers.append(worker)
+
+    def submit(self, msg):
+        # returns False when the message could not be queued
+        self._start()
+        try:
+            self.queue.put((msg, perf_counter()),
+                           timeout=self.app.config['MAIL_QUEUE_TIMEOUT'])
+        except queue.Full:
+            self.app.logger.error('Mail queue full, dropped %r to %s',
+                                  msg.subject, ', '.join(msg.recipients))
+            self.app.metrics.observe_mail('dropped', 0, 0.0, 0.0)
+            return False
+        return True
+
+    def join(self):
+        # waits until every queued message was sent or given up on
+        self.queue.join()
+
+    def _run(self):
+        with self.app.app_context():
+            # flask-mail connection, opened on the first message it sends
+            connection = mail.connect()
+            connection.host, connection.num_emails = None, 0
+            while True:
+                try:
+                    msg, queued = self.queue.get(
+                        timeout=self.app.config['MAIL_IDLE_TIMEOUT']
+                        if connection.host is not None else None)
+                except queue.Empty:
+                    self._disconnect(connection)
+                    continue
+                self._deliver(connection, msg, queued)
+                self.queue.task_done()
+
+    def _deliver(self, connection, msg, queued):
+        waited = perf_counter() - queued
+        start = perf_counter()
+        retries = 0
+        while True:
+            try:
+                if connection.host is None and not connection.mail.suppress:
+                    connection.host = connection.configure_host()
+                connection.send(msg)
+                outcome = 'sent'
+                break
+            except (smtplib.SMTPException, OSError) as e:
+                # rejected recipients and other permanent (5xx) errors are
+                # not going to go away by trying again
+                permanent = isinstance(e, smtplib.SMTPRecipientsRefused) or (
+                    isinstance(e, smtplib.SMTPResponseException) and
+                    e.smtp_code >= 500)
+                if permanent or retries >= self.app.config['MAIL_SEND_RETRIES']:
+                    self.app.logger.error('Could not send %r to %s: %s',
+                                          msg.subject,
+                                          ', '.join(msg.recipients), e)
+                    outcome = 'failed'
+                    break
+                self._disconnect(connection)
+                sleep(self.app.config['MAIL_RETRY_DELAY'] * 2 ** retries)
+                retries += 1
+            except Exception:
+                self.app.logger.exception('Could not send %r', msg.subject)
+                outcome = 'failed'
+                break
+        duration = perf_counter() - start
+        self.app.metrics.observe_mail(outcome, retries, waited, duration)
+        self.app.logger.debug('Mail %r %s after %.0fms in the queue, %.0fms '
+                              'and %d retries to send', msg.subject, outcome,
+                              waited * 1000, duration * 1000, retries)
+
+    def _disconnect(self, connection):
+        # the next message opens a new connection
+        if connection.host is not None:
+            try:
+                connection.host.quit()
+            except (smtplib.SMTPException, OSError):
+                connection.host.close()
+            connection.host = None
 
 
 # wrapper function for Message function to add custom attributes
@@ -23,7 +117,7 @@ def send_email(subject, sender, recipients, text_body, html_body, attachments=No
 
     if sync:
         mail.send(msg)
+        return True
 
-    else:
-
-        Thread(target=send_async_email, args=(current_app._get_current_object(), msg)).start()
+    # False when the mail queue stayed full
+    return current_app.mail_sender.submit(msg)
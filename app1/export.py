@@ -0,0 +1,48 @@
+# streaming export of the posts of a user, used by the export_posts task
+import json
+from time import time
+from app1.models import Post
+
+
+class ThrottledProgress(object):
+    # forwards progress to the task at most once per interval, each update
+    # of the task costs a job meta save, a notification and a commit
+    def __init__(self, set_progress, total, interval):
+        self.set_progress = set_progress
+        self.total = total
+        self.interval = interval
+        self.last_time = time()
+        self.last_progress = 0
+
+    def update(self, done):
+        # 100 is left for the caller, to be set once the export is delivered
+        progress = min(99, 100 * done // self.total) if self.total else 99
+        now = time()
+        if progress > self.last_progress and now - self.last_time >= self.interval:
+            self.set_progress(progress)
+            self.last_time = now
+            self.last_progress = progress
+
+
+def write_posts(user, f, batch_size=1000, progress=None):
+    # the posts are read in id-ordered batches and written out as they come,
+    # so neither the session nor the output grows with the number of posts
+    f.write('{\n    "posts": [')
+    last_id = 0
+    done = 0
+    while True:
+        batch = Post.query.with_entities(Post.id, Post.body, Post.timestamp).filter(
+            Post.user_id == user.id, Post.id > last_id).order_by(
+            Post.id).limit(batch_size).all()
+        if not batch:
+            break
+        for id, body, timestamp in batch:
+            f.write(',\n        ' if done else '\n        ')
+            f.write(json.dumps({'body': body,
+                                'timestamp': timestamp.isoformat() + 'Z'}))
+            done += 1
+        last_id = batch[-1].id
+        if progress:
+            progress(done)
+    f.write('\n    ]\n}\n')
+    return done
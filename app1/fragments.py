@@ -0,0 +1,194 @@
+# cache of rendered template fragments: the html of a post in a list and of
+# the user popups. Keys carry a version per post and per user, committed
+# changes to a post or to what the fragments show of a user bump its version
+# so the old fragments are never looked up again and simply age out of the
+# cache
+from threading import Lock
+import redis
+from flask import current_app, g, render_template
+from flask_login import current_user
+from jinja2 import Markup
+from app1 import db
+from app1.cache import LRUCache
+from app1.models import User, Post
+
+
+class LocalFragmentCache(object):
+    # fragments and versions in the memory of the process, only correct when
+    # a single process serves the application
+    def __init__(self, maxsize):
+        self.fragments = LRUCache(maxsize)
+        self.lock = Lock()
+        self.current = {}
+
+    def versions(self, names):
+        with self.lock:
+            return [self.current.get(name, 0) for name in names]
+
+    def bump(self, names):
+        with self.lock:
+            for name in names:
+                self.current[name] = self.current.get(name, 0) + 1
+
+    def get_many(self, keys):
+        return [self.fragments.get(key) for key in keys]
+
+    def set_many(self, fragments):
+        for key, html in fragments.items():
+            self.fragments.set(key, html)
+
+
+class RedisFragmentCache(object):
+    # fragments shared by all the processes, both fragments and versions
+    # expire after ttl seconds. Versions are taken from a single counter so
+    # they never repeat, a version that expired reads as 0 again, and the
+    # fragments of version 0 are older than the bump, so they expired too
+    def __init__(self, client, ttl):
+        self.client = client
+        self.ttl = ttl
+
+    def versions(self, names):
+        try:
+            values = self.client.mget(['fragment:version:' + name
+                                       for name in names])
+        except redis.exceptions.RedisError:
+            return None
+        return [int(value or 0) for value in values]
+
+    def bump(self, names):
+        try:
+            last = self.client.incrby('fragment:clock', len(names))
+            pipe = self.client.pipeline(transaction=False)
+            for i, name in enumerate(names):
+                pipe.setex('fragment:version:' + name, self.ttl, last - i)
+            pipe.execute()
+        except redis.exceptions.RedisError:
+            current_app.logger.warning('Could not invalidate fragments of %s',
+                                       ', '.join(names))
+
+    def get_many(self, keys):
+        try:
+            values = self.client.mget(keys)
+        except redis.exceptions.RedisError:
+            return [None] * len(keys)
+        return [value.decode('utf-8') if value is not None else None
+                for value in values]
+
+    def set_many(self, fragments):
+        try:
+            pipe = self.client.pipeline(transaction=False)
+            for key, html in fragments.items():
+                pipe.setex(key, self.ttl, html)
+            pipe.execute()
+        except redis.exceptions.RedisError:
+            pass
+
+
+def create_backend(app):
+    if app.config['FRAGMENT_CACHE'] == 'redis':
+        return RedisFragmentCache(app.redis, app.config['FRAGMENT_CACHE_TTL']) \
+            if app.redis else None
+    if app.config['FRAGMENT_CACHE'] == 'local':
+        return LocalFragmentCache(app.config['FRAGMENT_CACHE_SIZE'])
+    return None
+
+
+def invalidate(kind, ids):
+    # for changes made with plain sql statements, which the session events
+    # below do not see
+    if current_app.fragments is not None and ids:
+        current_app.fragments.bump(['{}:{}'.format(kind, id) for id in ids])
+
+
+def _cached(items, names, keys_for, render):
+    # names are the posts and users the fragments depend on, keys_for gives
+    # the key of every item from their versions, only the misses are rendered
+    cache = current_app.fragments
+    versions = cache.versions(names) if cache is not None and items else None
+    if versions is None:
+        return [render(item) for item in items]
+    keys = keys_for(dict(zip(names, versions)))
+    fragments = cache.get_many(keys)
+    missing = {}
+    for i, item in enumerate(items):
+        if fragments[i] is None:
+            fragments[i] = missing[keys[i]] = render(item)
+    if missing:
+        cache.set_many(missing)
+    return fragments
+
+
+def render_posts(posts):
+    # the html of a post depends on the post, its author and the language
+    # the page is rendered in
+    posts = list(posts)
+    names = list({'post:{}'.format(post.id) for post in posts} |
+                 {'user:{}'.format(post.user_id) for post in posts})
+
+    def keys_for(versions):
+        return ['fragment:post:{}:{}:{}:{}'.format(
+            post.id, versions['post:{}'.format(post.id)],
+            versions['user:{}'.format(post.user_id)], g.locale)
+            for post in posts]
+
+    return Markup(''.join(_cached(
+        posts, names, keys_for,
+        lambda post: render_template('main/_post.html', post=post))))
+
+
+def render_user_popup(user):
+    # besides the user, the popup shows last_seen, which is written by batch
+    # updates outside of the session, the counters, which do not bump the
+    # version, and a follow or unfollow link that depends on who is looking
+    if user == current_user:
+        relation = 'self'
+    elif current_user.is_following(user):
+        relation = 'following'
+    else:
+        relation = 'other'
+    name = 'user:{}'.format(user.id)
+
+    def keys_for(versions):
+        return ['fragment:popup:{}:{}:{}:{}:{}:{}:{}'.format(
+            user.id, versions[name],
+            user.last_seen.isoformat() if user.last_seen else '',
+            user.follower_count, user.follows_count, relation, g.locale)]
+
+    return _cached([user], [name], keys_for, lambda user: render_template(
+        'main/user_popup.html', user=user))[0]
+
+
+# changed posts and users are collected after each flush, while the session
+# still knows what was changed, and invalidated once the commit went through
+def after_flush(session, flush_context):
+    changed = session.info.setdefault('fragments', set())
+    for obj in session.deleted:
+        if isinstance(obj, (Post, User)):
+            changed.add('{}:{}'.format(
+                'post' if isinstance(obj, Post) else 'user', obj.id))
+    for obj in session.dirty:
+        if isinstance(obj, Post):
+            if session.is_modified(obj, include_collections=False):
+                changed.add('post:{}'.format(obj.id))
+        elif isinstance(obj, User):
+            # changes to the counters, tokens or the unread message count keep
+            # the fragments of the user
+            attrs = db.inspect(obj).attrs
+            if any(attrs[column].history.has_changes()
+                   for column in User.PROFILE_COLUMNS):
+                changed.add('user:{}'.format(obj.id))
+
+
+def after_commit(session):
+    changed = session.info.pop('fragments', None)
+    if changed and current_app.fragments is not None:
+        current_app.fragments.bump(sorted(changed))
+
+
+def after_rollback(session):
+    session.info.pop('fragments', None)
+
+
+db.event.listen(db.session, 'after_flush', after_flush)
+db.event.listen(db.session, 'after_commit', after_commit)
+db.event.listen(db.session, 'after_rollback', after_rollback)
@@ -0,0 +1,31 @@
+# conditional GET: views compute cheap validators (the newest post of a
+# listing, the updated_at of a user) before doing the real work, requests
+# that already have the current version get a 304 without the main query or
+# the rendering, and every route gets the Cache-Control policy configured
+# for it in CACHE_CONTROL
+from hashlib import sha1
+from flask import g, request, session, Response
+
+
+def not_modified(*validators):
+    # returns the 304 response to send back, or None when the view has to
+    # render, the validators are remembered for the headers of the response
+    if session.get('_flashes'):
+        # flashed messages are shown once, the page has to be rendered
+        return None
+    etag = sha1(repr(validators).encode('utf-8')).hexdigest()
+    g.etag = etag
+    if request.if_none_match.contains_weak(etag):
+        return Response(status=304)
+    return None
+
+
+def init_app(app):
+    @app.after_request
+    def add_cache_headers(response):
+        if g.get('etag') is not None and response.status_code in (200, 304):
+            response.set_etag(g.etag)
+        policy = app.config['CACHE_CONTROL'].get(request.endpoint)
+        if policy is not None:
+            response.headers['Cache-Control'] = policy
+        return response
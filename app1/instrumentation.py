@@ -0,0 +1,176 @@
+# per-request instrumentation: SQL statements, template rendering and the
+# calls to outside services are timed while a request runs, the totals are
+# sent back in a Server-Timing header, slow requests are logged and the
+# request latencies are kept in per-route histograms for /metrics
+from collections import defaultdict
+from contextlib import contextmanager
+from threading import Lock
+from time import perf_counter
+from flask import g, request, has_request_context, template_rendered, \
+    before_render_template, Response
+from redis import Redis
+from sqlalchemy import event
+from app1 import db
+
+# upper bounds of the latency histogram buckets, in seconds
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def _timings():
+    # components timed in the current request, None outside of requests
+    if not has_request_context():
+        return None
+    return g.get('timings')
+
+
+@contextmanager
+def timed(component):
+    timings = _timings()
+    if timings is None:
+        yield
+        return
+    start = perf_counter()
+    try:
+        yield
+    finally:
+        entry = timings[component]
+        entry[0] += 1
+        entry[1] += perf_counter() - start
+
+
+class TimedRedis(Redis):
+    # redis client that accounts its commands to the current request
+    def execute_command(self, *args, **options):
+        with timed('redis'):
+            return super(TimedRedis, self).execute_command(*args, **options)
+
+
+class Metrics(object):
+    def __init__(self):
+        self.lock = Lock()
+        self.requests = defaultdict(lambda: [0] * (len(BUCKETS) + 1))
+        self.durations = defaultdict(float)
+        self.components = defaultdict(float)
+        # outcome: [messages, retries, seconds queued, seconds sending]
+        self.mail = defaultdict(lambda: [0, 0, 0.0, 0.0])
+
+    def observe(self, endpoint, method, status, duration, timings):
+        bucket = len(BUCKETS)
+        for i, bound in enumerate(BUCKETS):
+            if duration <= bound:
+                bucket = i
+                break
+        with self.lock:
+            self.requests[(endpoint, method, status)][bucket] += 1
+            self.durations[(endpoint, method, status)] += duration
+            for component, (count, seconds) in timings.items():
+                self.components[(endpoint, component)] += seconds
+
+    def observe_mail(self, outcome, retries, waited, duration):
+        with self.lock:
+            entry = self.mail[outcome]
+            entry[0] += 1
+            entry[1] += retries
+            entry[2] += waited
+            entry[3] += duration
+
+    def render(self):
+        # prometheus text exposition format
+        lines = ['# TYPE microblog_request_duration_seconds histogram']
+        with self.lock:
+            for (endpoint, method, status), counts in sorted(self.requests.items()):
+                labels = 'endpoint="{}",method="{}",status="{}"'.format(
+                    endpoint, method, status)
+                total = 0
+                for bound, count in zip(BUCKETS + ('+Inf',), counts):
+                    total += count
+                    lines.append('microblog_request_duration_seconds_bucket'
+                                 '{{{},le="{}"}} {}'.format(labels, bound, total))
+                lines.append('microblog_request_duration_seconds_sum{{{}}} {}'.format(
+                    labels, self.durations[(endpoint, method, status)]))
+                lines.append('microblog_request_duration_seconds_count{{{}}} {}'.format(
+                    labels, total))
+            lines.append('# TYPE microblog_request_component_seconds counter')
+            for (endpoint, component), seconds in sorted(self.components.items()):
+                lines.append('microblog_request_component_seconds'
+                             '{{endpoint="{}",component="{}"}} {}'.format(
+                                 endpoint, component, seconds))
+            for name, i in (('messages_total', 0), ('retries_total', 1),
+                            ('queue_seconds_total', 2),
+                            ('send_seconds_total', 3)):
+                lines.append('# TYPE microblog_mail_{} counter'.format(name))
+                for outcome, entry in sorted(self.mail.items()):
+                    lines.append('microblog_mail_{}{{outcome="{}"}} {}'.format(
+                        name, outcome, entry[i]))
+        return '\n'.join(lines) + '\n'
+
+
+def init_app(app):
+    app.metrics = Metrics()
+
+    @event.listens_for(db.get_engine(app), 'before_cursor_execute')
+    def before_cursor_execute(conn, cursor, statement, parameters, context,
+                              executemany):
+        conn.info.setdefault('query_start', []).append(perf_counter())
+
+    @event.listens_for(db.get_engine(app), 'after_cursor_execute')
+    def after_cursor_execute(conn, cursor, statement, parameters, context,
+                             executemany):
+        start = conn.info['query_start'].pop()
+        timings = _timings()
+        if timings is not None:
+            entry = timings['sql']
+            entry[0] += 1
+            entry[1] += perf_counter() - start
+
+    # templates rendered from inside another template (cached fragments) are
+    # part of the outer rendering, only the outermost one is timed
+    def before_render(sender, template, context, **extra):
+        if _timings() is not None:
+            g.render_depth = g.get('render_depth', 0) + 1
+            if g.render_depth == 1:
+                g.render_start = perf_counter()
+
+    def rendered(sender, template, context, **extra):
+        timings = _timings()
+        if timings is not None and g.get('render_depth'):
+            g.render_depth -= 1
+            if g.render_depth == 0:
+                entry = timings['template']
+                entry[0] += 1
+                entry[1] += perf_counter() - g.render_start
+
+    before_render_template.connect(before_render, app, weak=False)
+    template_rendered.connect(rendered, app, weak=False)
+
+    @app.before_request
+    def start_timer():
+        g.timings = defaultdict(lambda: [0, 0.0])
+        g.request_start = perf_counter()
+
+    @app.after_request
+    def report_timings(response):
+        if g.get('request_start') is None:
+            return response
+        duration = perf_counter() - g.request_start
+        timings = g.timings
+        response.headers['Server-Timing'] = ', '.join(
+            ['{};dur={:.1f};desc="{} calls"'.format(
+                component, seconds * 1000, count)
+             for component, (count, seconds) in sorted(timings.items())] +
+            ['total;dur={:.1f}'.format(duration * 1000)])
+        # requests no route matched (404s) have no endpoint
+        app.metrics.observe(request.endpoint or '<unmatched>', request.method,
+                            response.status_code, duration, timings)
+        if duration >= app.config['SLOW_REQUEST_THRESHOLD']:
+            app.logger.warning('Slow request %s %s took %.0fms (%s)',
+                               request.method, request.path, duration * 1000,
+                               ', '.join('{} {:.0f}ms in {} calls'.format(
+                                   component, seconds * 1000, count)
+                                   for component, (count, seconds)
+                                   in sorted(timings.items())))
+        return response
+
+    if app.config['METRICS_ENABLED']:
+        app.add_url_rule('/metrics', 'metrics', lambda: Response(
+            app.metrics.render(), mimetype='text/plain; version=0.0.4'))
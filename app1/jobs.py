@@ -0,0 +1,171 @@
+# routing of the background jobs to the rq queues. Every job type goes to the
+# queue configured for it in TASK_ROUTES and the workers take jobs from the
+# queues in the order of TASK_QUEUES, so quick jobs are not stuck behind
+# exports. A job identical to one that is still waiting in a queue is not
+# queued again, and the queues in TASK_CONCURRENCY are worked on by at most
+# that many workers at a time
+import json
+from collections import OrderedDict
+from datetime import timedelta
+from hashlib import sha1
+from time import sleep, time
+from uuid import uuid4
+import redis
+import rq
+from flask import current_app
+
+
+def create_queues(app):
+    # rq queues by name, in priority order, none without redis
+    if app.redis is None:
+        return OrderedDict()
+    return OrderedDict((name, rq.Queue('microblog-' + name, connection=app.redis))
+                       for name in app.config['TASK_QUEUES'])
+
+
+def _pending_key(name, args, kwargs):
+    # same job type with the same arguments, same key
+    call = json.dumps([name, list(args), kwargs], sort_keys=True, default=str)
+    return 'microblog-pending:' + sha1(call.encode('utf-8')).hexdigest()
+
+
+def submit(name, *args, delay=None, **kwargs):
+    # queues app1.main.tasks.<name> and returns the id of the job, or of the
+    # identical job already waiting, None when there is no queue to use. Jobs
+    # with a delay are held by the rq scheduler for that many seconds
+    queues = current_app.task_queues
+    if not queues:
+        return None
+    queue = queues[current_app.config['TASK_ROUTES'].get(name, 'default')]
+    key = _pending_key(name, args, kwargs)
+    job_id = str(uuid4())
+    claimed = False
+    try:
+        if not current_app.redis.set(
+                key, job_id, nx=True,
+                ex=current_app.config['TASK_PENDING_TTL'] + int(delay or 0)):
+            pending = current_app.redis.get(key)
+            if pending is not None:
+                return pending.decode('utf-8')
+        claimed = True
+        # the worker loads jobs by name from app1.main.tasks, which exposes
+        # every background job under the name of the function implementing it
+        if delay:
+            queue.enqueue_in(timedelta(seconds=delay), 'app1.main.tasks.' + name,
+                             *args, job_id=job_id, **kwargs)
+        else:
+            queue.enqueue('app1.main.tasks.' + name, *args, job_id=job_id,
+                          **kwargs)
+    except redis.exceptions.RedisError:
+        current_app.logger.warning('Task queue unavailable, could not queue %s',
+                                   name)
+        if claimed:
+            # identical jobs must not wait for one that was never queued
+            try:
+                current_app.redis.delete(key)
+            except redis.exceptions.RedisError:
+                pass
+        return None
+    return job_id
+
+
+def enqueue(func, *args, delay=None, **kwargs):
+    job_id = submit(func.__name__, *args, delay=delay, **kwargs)
+    if job_id is None and delay is None:
+        # without a task queue (tests, single process setups) the job runs
+        # inline
+        func(*args, **kwargs)
+    return job_id
+
+
+def acquire_slot(connection, name, holder, limit, lease):
+    # semaphore of a queue: the holders are kept in a sorted set by the time
+    # their slot expires, so slots of dead workers free themselves, a holder
+    # got a slot when fewer than `limit` holders are ahead of it
+    key = 'microblog-running:' + name
+    now = time()
+    pipe = connection.pipeline()
+    pipe.zremrangebyscore(key, '-inf', now)
+    pipe.zadd(key, {holder: now + lease})
+    pipe.zrank(key, holder)
+    pipe.expire(key, int(lease) + 1)
+    rank = pipe.execute()[2]
+    if rank is not None and rank < limit:
+        return True
+    connection.zrem(key, holder)
+    return False
+
+
+def release_slot(connection, name, holder):
+    connection.zrem('microblog-running:' + name, holder)
+
+
+class Worker(rq.Worker):
+    # rq worker applying the concurrency limits. Before each dequeue it takes
+    # a slot of every limited queue it listens on, queues without a free slot
+    # are left out of that dequeue so their jobs stay queued, and the slots
+    # not needed for the dequeued job are given back right away. The slot of
+    # the queue the job came from is held until the job finished
+    def __init__(self, *args, **kwargs):
+        self.limits = kwargs.pop('limits', {})
+        self.lease = kwargs.pop('lease', 3600)
+        self.poll_interval = kwargs.pop('poll_interval', 5)
+        super(Worker, self).__init__(*args, **kwargs)
+
+    def _release(self, queues):
+        for queue in queues:
+            if queue.name in self.limits:
+                release_slot(self.connection, queue.name, self.name)
+
+    def dequeue_job_and_maintain_ttl(self, timeout, max_idle_time=None):
+        if not self.limits:
+            return super(Worker, self).dequeue_job_and_maintain_ttl(
+                timeout, max_idle_time)
+        # the dequeue waits for poll_interval at most, so that queues left
+        # out get another chance once one of their slots was given back
+        wait = None if timeout is None else self.poll_interval
+        ordered = self._ordered_queues
+        idle_since = time()
+        while True:
+            listening = [queue for queue in ordered
+                         if queue.name not in self.limits or acquire_slot(
+                             self.connection, queue.name, self.name,
+                             self.limits[queue.name], self.lease)]
+            result = None
+            if listening:
+                self._ordered_queues = listening
+                try:
+                    result = super(Worker, self).dequeue_job_and_maintain_ttl(
+                        wait, wait)
+                finally:
+                    self._ordered_queues = ordered
+                    self._release([queue for queue in listening
+                                   if result is None or queue is not result[1]])
+            if result is not None or timeout is None:
+                return result
+            if max_idle_time is not None and \
+                    time() - idle_since >= max_idle_time:
+                return None
+            if not listening:
+                sleep(self.poll_interval)
+
+    def execute_job(self, job, queue):
+        name = job.func_name.rsplit('.', 1)[-1]
+        # the job is running, an identical one gets queued again from now on
+        self.connection.delete(_pending_key(name, job.args, job.kwargs))
+        try:
+            return super(Worker, self).execute_job(job, queue)
+        finally:
+            self._release([queue])
+
+
+def work(redis_url, queues, limits, lease, burst=False):
+    # body of the worker processes started by the tasks worker command
+    connection = redis.Redis.from_url(redis_url)
+    worker = Worker([rq.Queue('microblog-' + name, connection=connection)
+                     for name in queues], connection=connection,
+                    limits={'microblog-' + name: limit
+                            for name, limit in limits.items()},
+                    lease=lease)
+    # the scheduler moves delayed jobs to their queue once they are due
+    worker.work(burst=burst, with_scheduler=True)
@@ -0,0 +1,92 @@
+# language detection of posts, done after the insert by a background job so
+# that submitting a post does not pay for it, Post.language stays NULL until
+# the detection ran and is '' when the language could not be told
+from datetime import datetime
+from multiprocessing import Pool
+from guess_language import guess_language
+from app1 import db, fragments
+from app1.models import User, Post
+
+
+def detect(text):
+    language = guess_language(text)
+    if language == 'UNKNOWN' or len(language) > 5:
+        language = ''
+    return language
+
+
+def _detect_row(row):
+    # runs in the worker processes of the backfill, away from the database
+    id, body = row
+    return id, detect(body)
+
+
+def _touch_authors(post_ids):
+    # the translate links are part of the pages validated by updated_at
+    post, user = Post.__table__, User.__table__
+    db.session.execute(user.update().where(user.c.id.in_(
+        db.select([post.c.user_id]).where(post.c.id.in_(post_ids)))).values(
+        updated_at=datetime.utcnow()))
+
+
+def _save(languages):
+    post = Post.__table__
+    db.session.execute(
+        post.update().where(post.c.id == db.bindparam('post_id')).values(
+            language=db.bindparam('detected')),
+        [{'post_id': id, 'detected': language} for id, language in languages])
+    _touch_authors([id for id, language in languages])
+    db.session.commit()
+    fragments.invalidate('post', [id for id, language in languages])
+
+
+def detect_post_language(post_id):
+    post = Post.__table__
+    body = db.session.execute(db.select([post.c.body]).where(
+        post.c.id == post_id)).scalar()
+    if body is None:
+        return None
+    language = detect(body)
+    # a language set in the meantime (by the backfill) is left alone
+    result = db.session.execute(post.update().where(db.and_(
+        post.c.id == post_id, post.c.language == None)).values(
+        language=language))
+    if result.rowcount:
+        _touch_authors([post_id])
+    db.session.commit()
+    # the translate link of the post depends on its language
+    fragments.invalidate('post', [post_id])
+    return language
+
+
+def backfill(batch_size=1000, processes=None, start_id=0, progress=None):
+    # posts without a language are read in id order, detected in a pool of
+    # processes and written back in one batch UPDATE per batch, the next
+    # batch is read while the pool works on the current one
+    post = Post.__table__
+
+    def read(after):
+        return [tuple(row) for row in db.session.execute(
+            db.select([post.c.id, post.c.body]).where(db.and_(
+                post.c.id > after,
+                db.or_(post.c.language == None, post.c.language == ''))).order_by(
+                post.c.id).limit(batch_size)).fetchall()]
+
+    done = 0
+    pool = Pool(processes)
+    try:
+        rows = read(start_id)
+        while rows:
+            last_id = rows[-1][0]
+            pending = pool.map_async(_detect_row, rows,
+                                     chunksize=max(1, len(rows) // 64))
+            rows = read(last_id)
+            languages = pending.get()
+            _save(languages)
+            done += len(languages)
+            if progress:
+                progress(done, last_id)
+    finally:
+        pool.terminate()
+        pool.join()
+    return done
@@ -0,0 +1,76 @@
+# coalesced tracking of User.last_seen: requests only record the activity
+# (in redis when available, otherwise in the memory of the process) and the
+# recorded times are written to the database in one batch UPDATE at most
+# once every LAST_SEEN_FLUSH_INTERVAL seconds
+from datetime import datetime
+from threading import Lock
+from time import time
+import redis
+from flask import current_app
+from app1 import db
+from app1.jobs import enqueue
+from app1.models import User
+
+_KEY = 'last_seen'
+_FLUSH_KEY = 'last_seen:flush'
+
+_pending = {}
+_lock = Lock()
+_next_flush = [0]
+
+
+def touch(user):
+    now = time()
+    interval = current_app.config['LAST_SEEN_FLUSH_INTERVAL']
+    if current_app.redis is not None:
+        try:
+            current_app.redis.hset(_KEY, user.id, now)
+            # whoever sets the flag first in a window schedules the flush
+            if current_app.redis.set(_FLUSH_KEY, 1, nx=True, ex=interval):
+                enqueue(flush_last_seen)
+            return
+        except redis.exceptions.RedisError:
+            pass
+    with _lock:
+        _pending[user.id] = now
+        due = now >= _next_flush[0]
+        if due:
+            _next_flush[0] = now + interval
+    if due:
+        flush_last_seen()
+
+
+def _drain():
+    seen = {}
+    if current_app.redis is not None:
+        try:
+            pipe = current_app.redis.pipeline()
+            pipe.hgetall(_KEY)
+            pipe.delete(_KEY)
+            recorded, _ = pipe.execute()
+            seen = {int(id): float(ts) for id, ts in recorded.items()}
+        except redis.exceptions.RedisError:
+            pass
+    with _lock:
+        for id, ts in _pending.items():
+            seen[id] = max(ts, seen.get(id, 0))
+        _pending.clear()
+    return seen
+
+
+def flush_last_seen():
+    seen = _drain()
+    if not seen:
+        return 0
+    user = User.__table__
+    # never move last_seen backwards if an older value is flushed late
+    db.session.execute(
+        user.update().where(db.and_(
+            user.c.id == db.bindparam('user_id'),
+            db.or_(user.c.last_seen == None,
+                   user.c.last_seen < db.bindparam('seen')))).values(
+            last_seen=db.bindparam('seen')),
+        [{'user_id': id, 'seen': datetime.utcfromtimestamp(ts)}
+         for id, ts in seen.items()])
+    db.session.commit()
+    return len(seen)
@@ -1,23 +1,32 @@
-from datetime import datetime
+import json
+from time import time
+import redis
 from flask import render_template, flash, redirect, url_for, request, g, \
-    jsonify, current_app
+    jsonify, current_app, Response
 from flask_login import current_user, login_required
 from flask_babel import _, get_locale
-from guess_language import guess_language
 from app1 import db
 from app1.main.forms import EditProfileForm, PostForm, SearchForm, MessageForm
-from app1.models import User, Post, Message, Notification
-from app1.translate import translate
+from app1.models import User, Post, Message, Notification, \
+    timeline as timeline_table
+from app1.translate import translate, translate_batch
+from app1.jobs import enqueue
+from app1.language import detect_post_language
+from app1.fragments import render_posts, render_user_popup
+from app1.pagination import paginate
+from app1.http_cache import not_modified
+from app1 import timeline, last_seen
 from app1.main import bp
 
+# post lists are rendered through the fragment cache
+bp.add_app_template_global(render_posts)
+
 
 @bp.before_app_request
 def before_request():
     if current_user.is_authenticated:
-        current_user.last_seen = datetime.utcnow()
-        # no need to put .add() before committing the new timestamp
-        # because the user is already in the database, we are just submitting the changes
-        db.session.commit()
+        # activity is only recorded here, it reaches the database in batches
+        last_seen.touch(current_user)
         # the search form should be available on every page the user is viewing,
         # so we store it in the g object so it is available during full application context
         g.search_form = SearchForm()
@@ -26,29 +35,41 @@ def before_request():
     g.locale = str(get_locale())
 
 
+def _viewer():
+    # what the pages show of the logged in user besides their content
+    return (current_user.id, current_user.unread_message_count, g.locale,
+            [task.id for task in current_user.get_tasks_in_progress()])
+
+
 @bp.route('/', methods=['GET', 'POST'])
 @bp.route('/index', methods=['GET', 'POST'])
 @login_required
 def index():
     form = PostForm()
     if form.validate_on_submit():
-        language = guess_language(form.post.data)
-        if language == 'UNKNOWN' or len(language) > 5:
-            language = ''
-        post = Post(body=form.post.data, author=current_user, language=language)
+        # the language is detected in the background, it is NULL until then
+        post = Post(body=form.post.data, author=current_user)
         db.session.add(post)
+        db.session.flush()
+        timeline.add_post(post)
         db.session.commit()
+        enqueue(timeline.fan_out_post, post.id)
+        enqueue(detect_post_language, post.id)
         flash(_('Your post is now live!'))
         return redirect(url_for('main.index'))
 
-    page = request.args.get('page', 1, type=int)
-    posts = current_user.followed_posts().paginate(
-        page, current_app.config['POSTS_PER_PAGE'], False)
+    # authors are loaded with the posts, _post.html needs each one of them
+    posts = current_user.timeline_posts().options(db.joinedload(Post.author))
+    posts = paginate(posts, (timeline_table.c.timestamp,
+                             timeline_table.c.post_id),
+                     current_app.config['POSTS_PER_PAGE'],
+                     request.args.get('cursor'),
+                     key=lambda post: (post.timestamp, post.id))
     # making links for next and previous page for navigation
-    next_url = url_for('main.index', page=posts.next_num) \
-        if posts.has_next else None
-    prev_url = url_for('main.index', page=posts.prev_num) \
-        if posts.has_prev else None
+    next_url = url_for('main.index', cursor=posts.next_cursor) \
+        if posts.next_cursor else None
+    prev_url = url_for('main.index', cursor=posts.prev_cursor) \
+        if posts.prev_cursor else None
 
     return render_template('main/index.html', title=_('Home'), form=form,
                            posts=posts.items, next_url=next_url,
@@ -58,13 +79,23 @@ def index():
 @bp.route('/explore')
 @login_required
 def explore():
-    page = request.args.get('page', 1, type=int)
-    posts = Post.query.order_by(Post.timestamp.desc()).paginate(
-        page, current_app.config['POSTS_PER_PAGE'], False)
-    next_url = url_for('main.explore', page=posts.next_num) \
-        if posts.has_next else None
-    prev_url = url_for('main.explore', page=posts.prev_num) \
-        if posts.has_prev else None
+    # the listing changes with new posts, changed authors and detected
+    # languages (which touch the updated_at of the author)
+    newest_id, newest_user = db.session.query(
+        db.func.max(Post.id),
+        db.select([db.func.max(User.updated_at)]).as_scalar()).one()
+    response = not_modified(request.full_path, newest_id, newest_user,
+                            *_viewer())
+    if response is not None:
+        return response
+    posts = paginate(Post.query.options(db.joinedload(Post.author)),
+                     (Post.timestamp, Post.id),
+                     current_app.config['POSTS_PER_PAGE'],
+                     request.args.get('cursor'))
+    next_url = url_for('main.explore', cursor=posts.next_cursor) \
+        if posts.next_cursor else None
+    prev_url = url_for('main.explore', cursor=posts.prev_cursor) \
+        if posts.prev_cursor else None
 
     return render_template('main/index.html', title=_('Explore'),
                            posts=posts.items, next_url=next_url,
@@ -76,13 +107,22 @@ def explore():
 
 def user(username):
     user = User.query.filter_by(username=username).first_or_404()
-    page = request.args.get('page', 1, type=int)
-    posts = user.posts.order_by(Post.timestamp.desc()).paginate(
-        page, current_app.config['POSTS_PER_PAGE'], False)
+    # everything the page shows of the user is in the row, new posts move
+    # the post count and detected languages updated_at
+    response = not_modified(request.full_path, user.id, user.updated_at,
+                            user.last_seen, user.post_count,
+                            user.follower_count, user.follows_count,
+                            *_viewer())
+    if response is not None:
+        return response
+    posts = paginate(user.posts.options(db.joinedload(Post.author)),
+                     (Post.timestamp, Post.id),
+                     current_app.config['POSTS_PER_PAGE'],
+                     request.args.get('cursor'))
     next_url = url_for('main.user', username=user.username,
-                       page=posts.next_num) if posts.has_next else None
+                       cursor=posts.next_cursor) if posts.next_cursor else None
     prev_url = url_for('main.user', username=user.username,
-                       page=posts.prev_num) if posts.has_prev else None
+                       cursor=posts.prev_cursor) if posts.prev_cursor else None
     return render_template('main/user.html', user=user, posts=posts.items,
                            next_url=next_url, prev_url=prev_url)
 
@@ -116,6 +156,7 @@ def follow(username):
         return redirect(url_for('main.user', username=username))
     current_user.follow(user)
     db.session.commit()
+    timeline.backfill(current_user, user)
     flash(_('You are following %(username)s!', username=username))
     return redirect(url_for('main.user', username=username))
 
@@ -132,6 +173,7 @@ def unfollow(username):
         return redirect(url_for('main.user', username=username))
     current_user.unfollow(user)
     db.session.commit()
+    timeline.prune(current_user, user)
     flash(_('You are not following %(username)s.', username=username))
     return redirect(url_for('main.user', username=username))
 
@@ -146,6 +188,32 @@ def translate_text():
                                       request.form['dest_language'])})
 
 
+@bp.route('/translate_batch', methods=['POST'])
+@login_required
+def translate_posts():
+    # translates every post shown on a page, with one call to the translator
+    # per source language for the posts that are not cached yet
+    # no more posts than a page shows
+    data = request.get_json(silent=True)
+    if not isinstance(data, dict) or not isinstance(data.get('posts'), list) \
+            or len(data['posts']) > current_app.config['POSTS_PER_PAGE'] \
+            or not isinstance(data.get('dest_language') or '', str):
+        return jsonify({'error': 'Bad Request'}), 400
+    ids = [id for id in data['posts'] if isinstance(id, int)]
+    posts = Post.query.filter(Post.id.in_(ids)).all() if ids else []
+    by_language = {}
+    for post in posts:
+        if post.language:
+            by_language.setdefault(post.language, []).append(post)
+    translations = {}
+    for language, group in by_language.items():
+        texts = translate_batch([post.body for post in group], language,
+                                data.get('dest_language') or g.locale)
+        for post, text in zip(group, texts):
+            translations[post.id] = text
+    return jsonify({'translations': translations})
+
+
 @bp.route('/search', methods=['GET'])
 @login_required
 def search():
@@ -155,6 +223,7 @@ def search():
     page = request.args.get('page', 1, type=int)
     posts, total = Post.search(g.search_form.q.data, page,
                                current_app.config['POSTS_PER_PAGE'])
+    posts = posts.options(db.joinedload(Post.author))
     next_url = url_for('main.search', q=g.search_form.q.data, page=page + 1) \
         if total > page * current_app.config['POSTS_PER_PAGE'] else None
     prev_url = url_for('main.search', q=g.search_form.q.data, page=page - 1) \
@@ -167,7 +236,7 @@ def search():
 @login_required
 def user_popup(username):
     user = User.query.filter_by(username=username).first_or_404()
-    return render_template('main/user_popup.html', user=user)
+    return render_user_popup(user)
 
 
 @bp.route('/send_message/<recipient>', methods=['GET', 'POST'])
@@ -178,7 +247,7 @@ def send_message(recipient):
     if form.validate_on_submit():
         msg = Message(author=current_user, recipient=user, body=form.message.data)
         db.session.add(msg)
-        user.add_notification('unread_message_count', user.new_messages())
+        user.add_notification('unread_message_count', user.add_unread_message())
         db.session.commit()
         flash(_('Your message has been sent'))
         return redirect(url_for('main.user', username=recipient))
@@ -187,14 +256,16 @@ def send_message(recipient):
 
 @bp.route('/messages', methods=['GET'])
 def messages():
-    current_user.last_message_read_time = datetime.utcnow()
+    current_user.read_messages()
     current_user.add_notification("unread_message_count", 0)
     db.session.commit()
-    page = request.args.get('page', 1, type=int)
-    messages = current_user.messages_received.order_by(Message.timestamp.desc()).paginate(
-        page, current_app.config['POSTS_PER_PAGE'], False)
-    next_url = url_for('main.messages', page=messages.next_num) if messages.has_next else None
-    prev_url = url_for('main.messages', page=messages.prev_num) if messages.has_prev else None
+    messages = current_user.messages_received.options(
+        db.joinedload(Message.author))
+    messages = paginate(messages, (Message.timestamp, Message.id),
+                        current_app.config['POSTS_PER_PAGE'],
+                        request.args.get('cursor'))
+    next_url = url_for('main.messages', cursor=messages.next_cursor) if messages.next_cursor else None
+    prev_url = url_for('main.messages', cursor=messages.prev_cursor) if messages.prev_cursor else None
 
     return render_template('main/messages.html', messages=messages.items, next_url=next_url, prev_url=prev_url)
 
@@ -212,12 +283,70 @@ def notifications():
     } for n in notifications])
 
 
+@bp.route('/notifications/stream')
+@login_required
+def notification_stream():
+    # server-sent events fed by redis pub/sub, so an idle client costs no
+    # database queries, without redis the client falls back to polling
+    if current_app.redis is None:
+        return '', 204
+    try:
+        pubsub = current_app.redis.pubsub(ignore_subscribe_messages=True)
+        pubsub.subscribe(Notification.channel(current_user.id))
+    except redis.exceptions.RedisError:
+        return '', 204
+    # notifications missed while disconnected are sent from the database,
+    # subscribing first makes sure nothing falls in between
+    since = request.headers.get('Last-Event-ID', type=float) or \
+        request.args.get('since', 0.0, type=float)
+    backlog = [json.dumps({'name': n.name, 'data': n.get_data(),
+                           'timestamp': n.timestamp})
+               for n in current_user.notifications.filter(
+                   Notification.timestamp > since).order_by(
+                   Notification.timestamp.asc())]
+    keepalive = current_app.config['NOTIFICATION_KEEPALIVE']
+    # the stream holds a worker while it is open, so it is closed after a
+    # while and the browser reconnects with the id of the last event
+    end = time() + current_app.config['NOTIFICATION_STREAM_LIFETIME']
+
+    def event(data):
+        return 'id: {}\ndata: {}\n\n'.format(json.loads(data)['timestamp'], data)
+
+    def stream():
+        sent = bool(backlog)
+        try:
+            for data in backlog:
+                yield event(data)
+            while time() < end:
+                message = pubsub.get_message(
+                    timeout=max(0, min(keepalive, end - time())))
+                if message is None:
+                    # comment lines keep proxies from closing the connection
+                    yield ': keepalive\n\n'
+                elif message['type'] == 'message':
+                    data = message['data']
+                    yield event(data.decode('utf-8')
+                                if isinstance(data, bytes) else data)
+                    sent = True
+            if not sent:
+                # without any event the reconnect would ask for everything
+                yield 'id: {}\n\n'.format(since)
+        finally:
+            pubsub.close()
+
+    return Response(stream(), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache',
+                             'X-Accel-Buffering': 'no'})
+
+
 @bp.route('/export_posts')
 @login_required
 def export_posts():
     if current_user.get_task_in_progress('export_posts'):
         flash(_('An export task is currently in progress'))
-    else:
-        current_user.launch_task('export_posts', _('Exporting posts...'))
+    elif current_user.launch_task('export_posts', _('Exporting posts...')):
         db.session.commit()
+    else:
+        # no task queue, or it could not be reached
+        flash(_('The export could not be started, please try again later'))
     return redirect(url_for('main.user', username=current_user.username))
\ No newline at end of file
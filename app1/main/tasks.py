@@ -1,13 +1,18 @@
 # this are the functions that run in the worker process
 
-import json
 import sys
-import time
+import tempfile
 from flask import render_template
 from rq import get_current_job
 from app1 import create_app, db
-from app1.models import User, Post, Task
+from app1.models import User, Task
 from app1.email import send_email
+from app1.export import ThrottledProgress, write_posts
+# background jobs implemented elsewhere and exposed to the worker from here
+from app1.timeline import fan_out_post
+from app1.last_seen import flush_last_seen
+from app1.search import flush_index_queue
+from app1.language import detect_post_language
 
 # app and the context must be created and pushed manually to be available for this process
 app = create_app()
@@ -34,25 +39,22 @@ def export_posts(user_id):
     try:
         user = User.query.get(user_id)
         _set_task_progress(0)
-        data = []
-        i = 0
-        total_posts = user.posts.count()
-        for post in user.posts.order_by(Post.timestamp.asc()):
-            data.append({'body': post.body,
-                         'timestamp': post.timestamp.isoformat() + 'Z'})
-            time.sleep(5)
-            i += 1
-            _set_task_progress(100 * i // total_posts)
-
-        send_email('[Microblog] Your blog posts',
-                sender=app.config['ADMINS'][0], recipients=[user.email],
-                text_body=render_template('email/export_posts.txt', user=user),
-                html_body=render_template('email/export_posts.html',
-                                          user=user),
-                # this is how flask-mail is expecting attachment to be served as an attribute, 3-piece tuple
-                attachments=[('posts.json', 'application/json',
-                              json.dumps({'posts': data}, indent=4))],
-                sync=True)
+        progress = ThrottledProgress(_set_task_progress, user.posts.count(),
+                                     app.config['EXPORT_PROGRESS_INTERVAL'])
+        # the json is streamed to disk and only read back for the attachment
+        with tempfile.TemporaryFile('w+', encoding='utf-8') as f:
+            write_posts(user, f, app.config['EXPORT_BATCH_SIZE'],
+                        progress.update)
+            f.seek(0)
+            send_email('[Microblog] Your blog posts',
+                    sender=app.config['ADMINS'][0], recipients=[user.email],
+                    text_body=render_template('email/export_posts.txt', user=user),
+                    html_body=render_template('email/export_posts.html',
+                                              user=user),
+                    # this is how flask-mail is expecting attachment to be served as an attribute, 3-piece tuple
+                    attachments=[('posts.json', 'application/json', f.read())],
+                    sync=True)
+        _set_task_progress(100)
     except:
         _set_task_progress(100)
-        app.logger.error('Unhandled exception', exc_info=sys.exc_info())
\ No newline at end of file
+        app.logger.error('Unhandled exception', exc_info=sys.exc_info())
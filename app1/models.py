@@ -1,15 +1,22 @@
 from app1 import db, login
 from flask import current_app, url_for
-from datetime import datetime
-from werkzeug.security import generate_password_hash, check_password_hash
+from datetime import datetime, timedelta
 from flask_login import UserMixin
+from sqlalchemy.orm import make_transient_to_detached
 from hashlib import md5
 import jwt
 from time import time
-from app1.search import add_to_index, remove_from_index, query_index
+from app1.search import query_index, index_change, remove_change, \
+    queue_changes, bulk_index
+import base64
+from app1 import passwords
+from app1.jobs import submit
 import json
+import os
 import redis
 import rq
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 
 
 class SearchableMixin(object):
@@ -36,30 +43,89 @@ class SearchableMixin(object):
         }
 
     @classmethod
-    # adding the changes to elastic database after the changes were committed
+    # handing the committed changes over to the search index queue, they are
+    # sent to elastic in bulk by a background job instead of in the request
     def after_commit(cls, session):
+        changes = []
         for obj in session._changes['add']:
             if isinstance(obj, SearchableMixin):
-                add_to_index(obj.__tablename__, obj)
+                changes.append(index_change(obj.__tablename__, obj))
         for obj in session._changes['update']:
             if isinstance(obj, SearchableMixin):
-                add_to_index(obj.__tablename__, obj)
+                changes.append(index_change(obj.__tablename__, obj))
         for obj in session._changes['delete']:
             if isinstance(obj, SearchableMixin):
-                remove_from_index(obj.__tablename__, obj)
+                changes.append(remove_change(obj.__tablename__, obj))
         session._changes = None
+        queue_changes(changes)
 
     @classmethod
     # method called to add existing entries to the index, to index the existing posts
-    def reindex(cls):
-        for obj in cls.query:
-            add_to_index(cls.__tablename__, obj)
+    # rows are streamed in id order, only the searchable columns are loaded,
+    # and the bulk requests are sent from a pool of worker threads
+    def reindex(cls, batch_size=500, workers=4, start_id=0, progress=None):
+        app = current_app._get_current_object()
+        columns = [cls.id] + [getattr(cls, field) for field in cls.__searchable__]
+
+        def send(changes):
+            with app.app_context():
+                bulk_index(changes)
+
+        pending = deque()
+        indexed = 0
+
+        def collect():
+            nonlocal indexed
+            future, count, last_id = pending.popleft()
+            future.result()
+            indexed += count
+            if progress:
+                # every id up to last_id is indexed, a safe point to resume from
+                progress(indexed, last_id)
+
+        last_id = start_id
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            while True:
+                rows = db.session.query(*columns).filter(
+                    cls.id > last_id).order_by(cls.id).limit(batch_size).all()
+                if not rows:
+                    break
+                last_id = rows[-1].id
+                changes = [{'index': cls.__tablename__, 'id': row[0],
+                            'doc': dict(zip(cls.__searchable__, row[1:]))}
+                           for row in rows]
+                pending.append((pool.submit(send, changes), len(rows), last_id))
+                # only keep a couple of batches per worker in flight
+                while len(pending) > workers * 2 or (
+                        pending and pending[0][0].done()):
+                    collect()
+            while pending:
+                collect()
+        return indexed
 
 
 followers = db.Table(
     'followers',
-    db.Column('follower_id', db.Integer, db.ForeignKey('user.id')),
-    db.Column('followed_id', db.Integer, db.ForeignKey('user.id'))
+    # the primary key serves the lookups by follower, the index by followed
+    db.Column('follower_id', db.Integer, db.ForeignKey('user.id'),
+              primary_key=True),
+    db.Column('followed_id', db.Integer, db.ForeignKey('user.id'),
+              primary_key=True),
+    db.Index('ix_followers_followed_id_follower_id', 'followed_id',
+             'follower_id')
+)
+
+
+# materialized home timelines, one row per (reader, post), filled on write
+timeline = db.Table(
+    'timeline',
+    db.Column('user_id', db.Integer, db.ForeignKey('user.id'),
+              primary_key=True),
+    db.Column('post_id', db.Integer, db.ForeignKey('post.id'),
+              primary_key=True),
+    # copy of the post timestamp so a page is a single index range scan
+    db.Column('timestamp', db.DateTime),
+    db.Index('ix_timeline_user_id_timestamp', 'user_id', 'timestamp')
 )
 
 
@@ -71,6 +137,12 @@ class User(UserMixin, db.Model):
     posts = db.relationship('Post', backref='author', lazy='dynamic')
     about_me = db.Column(db.String(140))
     last_seen = db.Column(db.DateTime, default=datetime.utcnow)
+    # what the lists of posts show of their author
+    PROFILE_COLUMNS = ('username', 'email', 'about_me')
+    # moved by changes to the profile columns and to the language of the
+    # posts of the user, validator of the cached pages and api responses,
+    # which validate last_seen and the counters on their own
+    updated_at = db.Column(db.DateTime, index=True, default=datetime.utcnow)
     follows = db.relationship(
         'User', secondary=followers,
         primaryjoin=(followers.c.follower_id == id),
@@ -81,31 +153,63 @@ class User(UserMixin, db.Model):
     messages_received = db.relationship('Message', foreign_keys='Message.recipient_id',
                                         backref='recipient', lazy='dynamic')
     last_message_read_time = db.Column(db.DateTime)
+    # maintained on send and reset when the messages are read
+    unread_message_count = db.Column(db.Integer, default=0)
+    # counter cache for the profile pages and the api, kept up to date by
+    # follow(), unfollow() and the Post insert/delete events below
+    post_count = db.Column(db.Integer, default=0)
+    follower_count = db.Column(db.Integer, default=0)
+    follows_count = db.Column(db.Integer, default=0)
     notifications = db.relationship('Notification', backref='user',
                                     lazy='dynamic')
     tasks = db.relationship('Task', backref='user', lazy='dynamic')
+    # bearer token of the api, looked up through the token cache
+    token = db.Column(db.String(32), index=True, unique=True)
+    token_expiration = db.Column(db.DateTime)
 
 
     def __repr__(self):
         return '<User {}>'.format(self.username)
 
     def set_password(self, password):
-        self.password_hash = generate_password_hash(password)
+        self.password_hash = passwords.hash_password(password)
 
     def check_password(self, password):
-        return check_password_hash(self.password_hash, password)
+        if not passwords.verify_password(self.password_hash, password):
+            return False
+        # hashed with an older method or work factor, the password is known
+        # now so it is hashed again, the caller commits the session
+        if passwords.needs_rehash(self.password_hash):
+            self.set_password(password)
+        return True
+
+    @property
+    # computed once per loaded user, pages ask for the avatar of the same user
+    # many times, the listeners below drop it when the email can change
+    def avatar_digest(self):
+        digest = self.__dict__.get('_avatar_digest')
+        if digest is None:
+            digest = self.__dict__['_avatar_digest'] = md5(
+                self.email.lower().encode('utf-8')).hexdigest()
+        return digest
 
     def avatar(self, size):
-        digest = md5(self.email.lower().encode('utf-8')).hexdigest()
-        return 'https://www.gravatar.com/avatar/{}?d=identicon&s={}'.format(digest, size)
+        return 'https://www.gravatar.com/avatar/{}?d=identicon&s={}'.format(
+            self.avatar_digest, size)
 
+    # the counters are updated with SQL expressions so concurrent follows
+    # don't overwrite each other, is_following() flushes the previous ones
     def follow(self, user):
         if not self.is_following(user):
             self.follows.append(user)
+            self.follows_count = db.func.coalesce(User.follows_count, 0) + 1
+            user.follower_count = db.func.coalesce(User.follower_count, 0) + 1
 
     def unfollow(self, user):
         if self.is_following(user):
             self.follows.remove(user)
+            self.follows_count = User.follows_count - 1
+            user.follower_count = User.follower_count - 1
 
     def is_following(self, user):
         return self.follows.filter(followers.c.followed_id == user.id).count() > 0
@@ -116,6 +220,12 @@ class User(UserMixin, db.Model):
             followers.c.follower_id == self.id)
         return followed.union(self.posts).order_by(Post.timestamp.desc())
 
+    # same posts as followed_posts(), read from the materialized timeline
+    def timeline_posts(self):
+        return Post.query.join(timeline, timeline.c.post_id == Post.id).filter(
+            timeline.c.user_id == self.id).order_by(
+            timeline.c.timestamp.desc(), timeline.c.post_id.desc())
+
     def get_reset_password_token(self, expires_in=600):
         return jwt.encode({'reset_password': self.id, 'exp': time() + expires_in},
                           current_app.config['SECRET_KEY'], algorithm='HS256').decode('utf-8')
@@ -130,9 +240,38 @@ class User(UserMixin, db.Model):
             return None
         return User.query.get(id)
 
+    def get_token(self, expires_in=3600):
+        now = datetime.utcnow()
+        if self.token and self.token_expiration > now + timedelta(seconds=60):
+            return self.token
+        self.token = base64.urlsafe_b64encode(os.urandom(24)).decode('utf-8')
+        self.token_expiration = now + timedelta(seconds=expires_in)
+        db.session.add(self)
+        return self.token
+
+    def revoke_token(self):
+        self.token_expiration = datetime.utcnow() - timedelta(seconds=1)
+
+    @staticmethod
+    def check_token(token):
+        user = User.query.filter_by(token=token).first()
+        if user is None or user.token_expiration < datetime.utcnow():
+            return None
+        return user
+
     def new_messages(self):
-        last_read_time = self.last_message_read_time or datetime(1900, 1, 1)
-        return Message.query.filter_by(recipient=self).filter(Message.timestamp > last_read_time).count()
+        return self.unread_message_count or 0
+
+    def add_unread_message(self):
+        # incremented in the database so concurrent senders don't lose counts
+        self.unread_message_count = db.func.coalesce(
+            User.unread_message_count, 0) + 1
+        db.session.flush()
+        return self.unread_message_count
+
+    def read_messages(self):
+        self.last_message_read_time = datetime.utcnow()
+        self.unread_message_count = 0
 
     def add_notification(self, name, data):
         self.notifications.filter_by(name=name).delete()
@@ -143,11 +282,15 @@ class User(UserMixin, db.Model):
 
 
     def launch_task(self, name, description, *args, **kwargs):
-        rq_job = current_app.task_queue.enqueue('app1.main.tasks.' + name, self.id,
-                                                *args, **kwargs)
-        task = Task(id=rq_job.get_id(), name=name, description=description,
-                    user=self)
-        db.session.add(task)
+        job_id = submit(name, self.id, *args, **kwargs)
+        if job_id is None:
+            return None
+        # a request for a job that is still waiting gets its task back
+        task = Task.query.get(job_id)
+        if task is None:
+            task = Task(id=job_id, name=name, description=description,
+                        user=self)
+            db.session.add(task)
         return task
 
     def get_tasks_in_progress(self):
@@ -157,19 +300,25 @@ class User(UserMixin, db.Model):
         return Task.query.filter_by(name=name, user=self,
         complete=False).first()
 
-    def to_dict(self, include_email=False):
+    # collections pass the url of the users collection, the links of every
+    # user are built from it instead of with three url_for calls per user
+    def to_dict(self, include_email=False, users_url=None):
+        if users_url is None:
+            users_url = url_for('api.get_users')
+        url = '{}/{}'.format(users_url, self.id)
         data = {
             'id': self.id,
             'username': self.username,
-            'last_seen': self.last_seen.isoformat() + 'Z',
+            'last_seen': self.last_seen.isoformat() + 'Z'
+            if self.last_seen else None,
             'about_me': self.about_me,
-            'post_count': self.posts.count(),
-            'follower_count': self.followers.count(),
-            'follows_count': self.follows.count(),
+            'post_count': self.post_count,
+            'follower_count': self.follower_count,
+            'follows_count': self.follows_count,
             '_links': {
-                'self': url_for('api.get_user', id=self.id),
-                'followers': url_for('api.get_followers', id=self.id),
-                'follows': url_for('api.get_follows', id=self.id),
+                'self': url,
+                'followers': url + '/followers',
+                'follows': url + '/followed',
                 'avatar': self.avatar(128)
             }
         }
@@ -177,6 +326,26 @@ class User(UserMixin, db.Model):
             data['email'] = self.email
         return data
 
+    @staticmethod
+    # recompute every counter cache from the source tables in bulk
+    def repair_counters():
+        user = User.__table__
+
+        def count(table, column):
+            return db.select([db.func.count()]).select_from(table).where(
+                column == user.c.id).as_scalar()
+
+        db.session.execute(user.update().values(
+            post_count=count(Post.__table__, Post.__table__.c.user_id),
+            follower_count=count(followers, followers.c.followed_id),
+            follows_count=count(followers, followers.c.follower_id),
+            unread_message_count=db.select([db.func.count()]).where(db.and_(
+                Message.recipient_id == user.c.id,
+                db.or_(user.c.last_message_read_time == None,
+                       Message.timestamp > user.c.last_message_read_time))
+            ).as_scalar()))
+        db.session.commit()
+
     def from_dict(self, data, new_user=False):
         for field in ['username', 'email', 'about_me']:
             if field in data:
@@ -185,9 +354,105 @@ class User(UserMixin, db.Model):
             self.set_password(data['password'])
 
 
+# credentials stay out of the user cache, they are loaded from the database
+# the first time a cached user needs them
+_UNCACHED_COLUMNS = ('password_hash', 'token', 'token_expiration')
+
+
+def _user_values(user):
+    values = {}
+    for column in User.__table__.columns:
+        if column.key in _UNCACHED_COLUMNS:
+            continue
+        value = getattr(user, column.key)
+        values[column.key] = value.isoformat() \
+            if isinstance(value, datetime) else value
+    return values
+
+
+def _cached_user(values):
+    # a user built from the cached columns and attached to the session as if
+    # it had been loaded, without a query. The credential columns are left
+    # unloaded
+    user = User()
+    for column in User.__table__.columns:
+        if column.key in _UNCACHED_COLUMNS:
+            continue
+        value = values.get(column.key)
+        if value is not None and isinstance(column.type, db.DateTime):
+            value = datetime.strptime(value, '%Y-%m-%dT%H:%M:%S.%f'
+                                      if '.' in value else '%Y-%m-%dT%H:%M:%S')
+        setattr(user, column.key, value)
+    make_transient_to_detached(user)
+    return db.session.merge(user, load=False)
+
+
 @login.user_loader
 def load_user(id):
-    return User.query.get(int(id))
+    # the user of the session comes from the user cache, changes to users
+    # drop them from it (see below) and the rest expires after a short ttl
+    loaded = []
+
+    def load():
+        user = User.query.get(int(id))
+        if user is None:
+            return None, None
+        loaded.append(user)
+        return _user_values(user), current_app.config['USER_CACHE_TTL']
+
+    values = current_app.user_cache.get(str(int(id)), load)
+    if loaded:
+        return loaded[0]
+    return _cached_user(values) if values is not None else None
+
+
+def _touch_changed_profiles(session, flush_context, instances):
+    for user in session.dirty:
+        if isinstance(user, User):
+            attrs = db.inspect(user).attrs
+            if any(attrs[column].history.has_changes()
+                   for column in User.PROFILE_COLUMNS):
+                user.updated_at = datetime.utcnow()
+
+
+db.event.listen(db.session, 'before_flush', _touch_changed_profiles)
+
+
+# changed or deleted users are collected after each flush and dropped from
+# the user cache once the commit went through
+def _collect_changed_users(session, flush_context):
+    changed = session.info.setdefault('changed_users', set())
+    for user in list(session.dirty) + list(session.deleted):
+        if isinstance(user, User) and (
+                user in session.deleted or
+                session.is_modified(user, include_collections=False)):
+            changed.add(user.id)
+
+
+def _drop_changed_users(session):
+    changed = session.info.pop('changed_users', None)
+    if changed:
+        current_app.user_cache.invalidate(sorted(changed))
+
+
+def _forget_changed_users(session):
+    session.info.pop('changed_users', None)
+
+
+db.event.listen(db.session, 'after_flush', _collect_changed_users)
+db.event.listen(db.session, 'after_commit', _drop_changed_users)
+db.event.listen(db.session, 'after_rollback', _forget_changed_users)
+
+
+@db.event.listens_for(User.email, 'set')
+def _email_changed(user, value, oldvalue, initiator):
+    user.__dict__.pop('_avatar_digest', None)
+
+
+@db.event.listens_for(User, 'expire')
+def _user_expired(user, attrs):
+    if user is not None and (attrs is None or 'email' in attrs):
+        user.__dict__.pop('_avatar_digest', None)
 
 
 class Post(SearchableMixin, db.Model):
@@ -197,6 +462,9 @@ class Post(SearchableMixin, db.Model):
     timestamp = db.Column(db.DateTime, index=True, default=datetime.utcnow)
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'))
     language = db.Column(db.String(5))
+    __table_args__ = (
+        db.Index('ix_post_user_id_timestamp', 'user_id', 'timestamp'),
+    )
 
     def __repr__(self):
         return '<Post {}>'.format(self.body)
@@ -206,12 +474,31 @@ db.event.listen(db.session, 'before_commit', Post.before_commit)
 db.event.listen(db.session, 'after_commit', Post.after_commit)
 
 
+# keeping User.post_count in step with the post table, in the same transaction
+@db.event.listens_for(Post, 'after_insert')
+def _count_new_post(mapper, connection, post):
+    connection.execute(User.__table__.update().where(
+        User.__table__.c.id == post.user_id).values(
+        post_count=db.func.coalesce(User.__table__.c.post_count, 0) + 1))
+
+
+@db.event.listens_for(Post, 'after_delete')
+def _count_deleted_post(mapper, connection, post):
+    connection.execute(User.__table__.update().where(
+        User.__table__.c.id == post.user_id).values(
+        post_count=User.__table__.c.post_count - 1))
+
+
 class Message(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     sender_id = db.Column(db.Integer, db.ForeignKey('user.id'))
     recipient_id = db.Column(db.Integer, db.ForeignKey('user.id'))
     body = db.Column(db.String(140))
     timestamp = db.Column(db.DateTime, index=True, default=datetime.utcnow)
+    __table_args__ = (
+        db.Index('ix_message_recipient_id_timestamp', 'recipient_id',
+                 'timestamp'),
+    )
 
     def __repr__(self):
         return '<Message {}>'.format(self.body)
@@ -224,10 +511,52 @@ class Notification(db.Model):
     timestamp = db.Column(db.Float, index=True, default=time)
     # this will be a JSON string
     payload_json = db.Column(db.Text)
+    __table_args__ = (
+        db.Index('ix_notification_user_id_name', 'user_id', 'name'),
+        db.Index('ix_notification_user_id_timestamp', 'user_id', 'timestamp'),
+    )
 
     def get_data(self):
         return json.loads(str(self.payload_json))
 
+    @staticmethod
+    # redis pub/sub channel the notifications of a user are pushed to
+    def channel(user_id):
+        return 'notifications:{}'.format(user_id)
+
+    @classmethod
+    # collecting the new notifications after the flush, when the user ids
+    # and timestamps are set but nothing has been expired by the commit yet
+    def after_flush(cls, session, flush_context):
+        session.info.setdefault('notifications', []).extend(
+            (n.user_id, {'name': n.name, 'data': n.get_data(),
+                         'timestamp': n.timestamp})
+            for n in session.new if isinstance(n, cls))
+
+    @classmethod
+    # pushing the committed notifications to the listening clients
+    def after_commit(cls, session):
+        notifications = session.info.pop('notifications', None)
+        if not notifications or current_app.redis is None:
+            return
+        try:
+            pipe = current_app.redis.pipeline(transaction=False)
+            for user_id, data in notifications:
+                pipe.publish(cls.channel(user_id), json.dumps(data))
+            pipe.execute()
+        except redis.exceptions.RedisError:
+            # clients still catch up from the database when they reconnect
+            current_app.logger.warning('Could not publish notifications')
+
+    @classmethod
+    def after_rollback(cls, session):
+        session.info.pop('notifications', None)
+
+
+db.event.listen(db.session, 'after_flush', Notification.after_flush)
+db.event.listen(db.session, 'after_commit', Notification.after_commit)
+db.event.listen(db.session, 'after_rollback', Notification.after_rollback)
+
 
 class Task(db.Model):
     id = db.Column(db.String(36), primary_key=True)
@@ -237,6 +566,8 @@ class Task(db.Model):
     complete = db.Column(db.Boolean, default=False)
 
     def get_rq_job(self):
+        if current_app.redis is None:
+            return None
         try:
             rq_job = rq.job.Job.fetch(self.id, connection=current_app.redis)
         except (redis.exceptions.RedisError, rq.exceptions.NoSuchJobError):
@@ -0,0 +1,83 @@
+# keyset (cursor) pagination: a page is located with a WHERE clause on the
+# sort columns of the row next to it instead of an OFFSET, so deep pages are
+# as cheap as the first one. Listings are ordered newest first by
+# (timestamp, id) unless they ask for another order
+from base64 import urlsafe_b64encode, urlsafe_b64decode
+from datetime import datetime
+from app1 import db
+
+_TIMESTAMP_FORMAT = '%Y-%m-%dT%H:%M:%S.%f'
+
+
+class CursorPage(object):
+    def __init__(self, items, next_cursor, prev_cursor):
+        self.items = items
+        # cursors are opaque strings to be passed back in the query string
+        self.next_cursor = next_cursor
+        self.prev_cursor = prev_cursor
+
+
+def encode_cursor(direction, *values):
+    raw = '|'.join([direction] + [value.strftime(_TIMESTAMP_FORMAT)
+                                  if isinstance(value, datetime) else str(value)
+                                  for value in values])
+    return urlsafe_b64encode(raw.encode('utf-8')).decode('ascii').rstrip('=')
+
+
+def decode_cursor(cursor, columns):
+    # the values are parsed by the type of the column they belong to,
+    # anything that does not decode is treated as a request for the first page
+    try:
+        raw = urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4))
+        direction, *values = raw.decode('utf-8').split('|')
+        if direction not in ('next', 'prev') or len(values) != len(columns):
+            return None
+        return direction, [
+            datetime.strptime(value, _TIMESTAMP_FORMAT)
+            if isinstance(column.type, db.DateTime) else int(value)
+            for column, value in zip(columns, values)]
+    except (TypeError, ValueError):
+        return None
+
+
+def _after(columns, values, descending):
+    # rows that come after the given values in the order of the columns
+    clauses = []
+    for i, (column, value) in enumerate(zip(columns, values)):
+        ties = [c == v for c, v in zip(columns[:i], values[:i])]
+        clauses.append(db.and_(*ties + [column < value if descending
+                                        else column > value]))
+    return db.or_(*clauses)
+
+
+def paginate(query, columns, per_page, cursor=None, key=None, descending=True):
+    # columns is the sort column or a tuple of them, the last one unique. key
+    # maps a result item to the tuple of values of those columns, by default
+    # they are read from the item attributes with the same names
+    if not isinstance(columns, (tuple, list)):
+        columns = (columns,)
+    columns = tuple(columns)
+    if key is None:
+        key = lambda item: tuple(getattr(item, column.key)
+                                 for column in columns)
+    position = decode_cursor(cursor, columns) if cursor else None
+    query = query.order_by(None)
+    direction = 'next' if position is None else position[0]
+    # rows before the cursor are read in the opposite order and flipped
+    # afterwards
+    forward = descending if direction == 'next' else not descending
+    if position is not None:
+        query = query.filter(_after(columns, position[1], forward))
+    rows = query.order_by(*[column.desc() if forward else column.asc()
+                            for column in columns]).limit(per_page + 1).all()
+    more = len(rows) > per_page
+    items = rows[:per_page]
+    if direction == 'prev':
+        items.reverse()
+    if not items:
+        return CursorPage(items, None, None)
+    has_next = more if direction == 'next' else True
+    has_prev = position is not None if direction == 'next' else more
+    next_cursor = encode_cursor('next', *key(items[-1])) if has_next else None
+    prev_cursor = encode_cursor('prev', *key(items[0])) if has_prev else None
+    return CursorPage(items, next_cursor, prev_cursor)
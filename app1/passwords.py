@@ -0,0 +1,75 @@
+# password hashing with a configurable method and work factor. The hashing
+# and the verification can run in a bounded pool of processes, so a burst of
+# logins keeps the cpu of the pool busy instead of the web workers
+import atexit
+from concurrent.futures import ProcessPoolExecutor
+from threading import BoundedSemaphore, Lock
+from flask import current_app
+from werkzeug.security import generate_password_hash, check_password_hash
+
+
+class HashingPool(object):
+    # the process pool of an application, started on the first hash and
+    # started again with the new size when PASSWORD_HASH_PROCESSES changed. At
+    # most PASSWORD_HASH_QUEUE hashes per process are waiting or running at a
+    # time, further logins wait for a slot instead of piling up
+    def __init__(self, app):
+        self.app = app
+        self.lock = Lock()
+        self.executor = None
+        self.slots = None
+        self.processes = 0
+
+    def run(self, func, *args):
+        processes = self.app.config['PASSWORD_HASH_PROCESSES']
+        if not processes:
+            return func(*args)
+        with self.lock:
+            if self.executor is None or self.processes != processes:
+                if not self.processes:
+                    # the worker processes are stopped with the interpreter
+                    atexit.register(self.shutdown)
+                self._stop()
+                self.executor = ProcessPoolExecutor(max_workers=processes)
+                self.slots = BoundedSemaphore(
+                    processes * self.app.config['PASSWORD_HASH_QUEUE'])
+                self.processes = processes
+            executor, slots = self.executor, self.slots
+        with slots:
+            return executor.submit(func, *args).result()
+
+    def _stop(self):
+        # hashes already submitted to the old pool still finish
+        if self.executor is not None:
+            self.executor.shutdown(wait=False)
+            self.executor = None
+
+    def shutdown(self):
+        with self.lock:
+            self._stop()
+
+
+def method():
+    # werkzeug method string, the work factor is the number of iterations of
+    # the pbkdf2 methods, the other methods have none
+    method = current_app.config['PASSWORD_HASH_METHOD']
+    if method.startswith('pbkdf2:'):
+        return '{}:{}'.format(method,
+                              current_app.config['PASSWORD_HASH_ITERATIONS'])
+    return method
+
+
+def hash_password(password):
+    return current_app.password_pool.run(generate_password_hash, password,
+                                         method())
+
+
+def verify_password(pwhash, password):
+    if not pwhash:
+        return False
+    return current_app.password_pool.run(check_password_hash, pwhash, password)
+
+
+def needs_rehash(pwhash):
+    # hashes made with other parameters are replaced on the next login
+    return pwhash.split('$', 1)[0] != method()
@@ -1,28 +1,217 @@
+import json
+import re
+import sqlite3
+import time
+from threading import Lock
+import redis
+from elasticsearch.exceptions import TransportError
 from flask import current_app
-# making wrapper functions for easier use of elastic
+from app1.jobs import enqueue
+from app1.instrumentation import timed
+# making wrapper functions for easier use of elastic, or of the built-in
+# sqlite index when there is no elastic service to talk to
 
+# index changes waiting for the next bulk request, oldest first
+_QUEUE_KEY = 'search:pending'
+# set while a flush job is scheduled, so a burst of commits shares one job
+_FLUSH_KEY = 'search:flush'
 
-def add_to_index(index, model):
-    if not current_app.elasticsearch:
-        return
+
+class ElasticsearchBackend(object):
+    # errors worth retrying, the request may succeed a moment later
+    retry_errors = (TransportError,)
+
+    def __init__(self, client):
+        self.client = client
+
+    def bulk(self, changes):
+        body = []
+        for change in changes:
+            meta = {'_index': change['index'], '_type': change['index'],
+                    '_id': change['id']}
+            if change.get('doc') is None:
+                body.append({'delete': meta})
+            else:
+                body.append({'index': meta})
+                body.append(change['doc'])
+        with timed('search'):
+            response = self.client.bulk(body=body)
+        if response.get('errors'):
+            for item in response['items']:
+                for op, result in item.items():
+                    # removing a document that was never indexed is not an error
+                    if result.get('status', 500) >= 300 and not (
+                            op == 'delete' and result.get('status') == 404):
+                        current_app.logger.error(
+                            'Search %s of %s/%s failed: %s', op,
+                            result.get('_index'), result.get('_id'),
+                            result.get('error'))
+
+    def query(self, index, query, page, per_page):
+        with timed('search'):
+            search = self.client.search(
+                index=index, doc_type=index,
+                body={'query': {'multi_match': {'query': query,
+                                                'fields': ['*']}},
+                      'from': (page - 1) * per_page, 'size': per_page})
+        ids = [int(hit['_id']) for hit in search['hits']['hits']]
+        return ids, search['hits']['total']
+
+
+class LocalSearchBackend(object):
+    # full-text index kept in a sqlite fts5 table per index, ranked with bm25
+    retry_errors = (sqlite3.OperationalError,)
+
+    def __init__(self, path):
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.lock = Lock()
+        self.tables = set()
+
+    def _table(self, index):
+        table = 'search_' + re.sub(r'\W', '_', index)
+        if table not in self.tables:
+            # all the searchable fields go into one column, like the
+            # multi_match over all fields of the elastic query
+            self.connection.execute(
+                'CREATE VIRTUAL TABLE IF NOT EXISTS {} USING fts5(content)'.format(
+                    table))
+            self.tables.add(table)
+        return table
+
+    def bulk(self, changes):
+        with timed('search'), self.lock, self.connection:
+            for change in changes:
+                table = self._table(change['index'])
+                self.connection.execute(
+                    'DELETE FROM {} WHERE rowid = ?'.format(table), (change['id'],))
+                if change.get('doc') is not None:
+                    content = ' '.join(str(value) for value in change['doc'].values()
+                                       if value is not None)
+                    self.connection.execute(
+                        'INSERT INTO {} (rowid, content) VALUES (?, ?)'.format(table),
+                        (change['id'], content))
+
+    def query(self, index, query, page, per_page):
+        # any of the words may match, as with the default elastic operator
+        words = re.findall(r'\w+', query)
+        if not words:
+            return [], 0
+        expression = ' OR '.join('"{}"'.format(word) for word in words)
+        with timed('search'), self.lock:
+            table = self._table(index)
+            total = self.connection.execute(
+                'SELECT count(*) FROM {0} WHERE {0} MATCH ?'.format(table),
+                (expression,)).fetchone()[0]
+            rows = self.connection.execute(
+                'SELECT rowid FROM {0} WHERE {0} MATCH ? ORDER BY rank, rowid '
+                'LIMIT ? OFFSET ?'.format(table),
+                (expression, per_page, (page - 1) * per_page)).fetchall()
+        return [row[0] for row in rows], total
+
+
+def create_backend(app):
+    if app.config['SEARCH_BACKEND'] == 'elasticsearch':
+        return ElasticsearchBackend(app.elasticsearch) \
+            if app.elasticsearch else None
+    if app.config['SEARCH_BACKEND'] == 'local':
+        return LocalSearchBackend(app.config['SEARCH_INDEX_PATH'])
+    return None
+
+
+def _document(model):
     payload = {}
     for field in model.__searchable__:
         payload[field] = getattr(model, field)
-        current_app.elasticsearch.index(index=index, doc_type=index, id=model.id, body=payload)
+    return payload
+
+
+# index changes are plain dicts, a missing 'doc' means the entry is removed
+def index_change(index, model):
+    return {'index': index, 'id': model.id, 'doc': _document(model)}
+
+
+def remove_change(index, model):
+    return {'index': index, 'id': model.id}
+
+
+def add_to_index(index, model):
+    if not current_app.search:
+        return
+    current_app.search.bulk([index_change(index, model)])
 
 
 def remove_from_index(index, model):
-    if not current_app.elasticsearch:
+    if not current_app.search:
         return
-    current_app.elasticsearch.delete(index=index, doc_type=index, id=model.id)
+    current_app.search.bulk([remove_change(index, model)])
 
 
 def query_index(index, query, page, per_page):
-    if not current_app.elasticsearch:
+    if not current_app.search:
         return [], 0
-    search = current_app.elasticsearch.search(
-        index=index, doc_type=index,
-        body={'query': {'multi_match': {'query': query, 'fields': ['*']}},
-              'from': (page - 1) * per_page, 'size': per_page})
-    ids = [int(hit['_id']) for hit in search['hits']['hits']]
-    return ids, search['hits']['total']
\ No newline at end of file
+    return current_app.search.query(index, query, page, per_page)
+
+
+def bulk_index(changes):
+    # send a batch of index changes in a single bulk request, retrying with
+    # exponential backoff when the search service cannot be reached
+    retries = current_app.config['SEARCH_INDEX_RETRIES']
+    for attempt in range(retries + 1):
+        try:
+            return current_app.search.bulk(changes)
+        except current_app.search.retry_errors:
+            if attempt == retries:
+                raise
+            time.sleep(0.5 * 2 ** attempt)
+
+
+def queue_changes(changes):
+    if not current_app.search or not changes:
+        return
+    if current_app.redis is not None:
+        try:
+            current_app.redis.rpush(_QUEUE_KEY,
+                                    *[json.dumps(change) for change in changes])
+            if current_app.redis.set(_FLUSH_KEY, 1, nx=True, ex=60):
+                enqueue(flush_index_queue)
+            return
+        except redis.exceptions.RedisError:
+            current_app.logger.warning('Search queue unavailable, indexing '
+                                       'in process')
+    # the commit went through already, so the request neither waits for
+    # retries nor fails when the search service is down. Changes that could
+    # not be sent are missing from the index until the next reindex
+    batch_size = current_app.config['SEARCH_BATCH_SIZE']
+    for i in range(0, len(changes), batch_size):
+        try:
+            current_app.search.bulk(changes[i:i + batch_size])
+        except current_app.search.retry_errors as e:
+            current_app.logger.error('Could not index %d changes: %s',
+                                     len(changes[i:i + batch_size]), e)
+
+
+def flush_index_queue():
+    # the flag is cleared before draining, changes queued after this point
+    # either make it into this run or schedule a new job
+    current_app.redis.delete(_FLUSH_KEY)
+    batch_size = current_app.config['SEARCH_BATCH_SIZE']
+    flushed = 0
+    while True:
+        pipe = current_app.redis.pipeline()
+        pipe.lrange(_QUEUE_KEY, 0, batch_size - 1)
+        pipe.ltrim(_QUEUE_KEY, batch_size, -1)
+        batch, _ = pipe.execute()
+        if not batch:
+            return flushed
+        changes = [json.loads(change) for change in batch]
+        try:
+            bulk_index(changes)
+        except current_app.search.retry_errors:
+            # put the batch back in front of the queue for the next job, which
+            # is scheduled here as nothing else might queue a change for a
+            # while
+            current_app.redis.lpush(_QUEUE_KEY, *reversed(batch))
+            enqueue(flush_index_queue,
+                    delay=current_app.config['SEARCH_FLUSH_RETRY_DELAY'])
+            raise
+        flushed += len(changes)
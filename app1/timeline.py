@@ -0,0 +1,88 @@
+# fan-out-on-write home timelines: a new post is copied into the timeline of
+# its author and of every follower, so reading a page of the home page is a
+# range scan on (user_id, timestamp) no matter how many users someone follows
+from flask import current_app
+from app1 import db
+from app1.models import User, Post, followers, timeline
+
+
+def _not_in_timeline(user_id, post_id):
+    return ~db.exists().where(db.and_(timeline.c.user_id == user_id,
+                                      timeline.c.post_id == post_id))
+
+
+def _trim(user_ids):
+    # drop everything older than the newest TIMELINE_LENGTH entries of each user
+    newer = timeline.alias()
+    cutoff = db.select([newer.c.timestamp]).where(
+        newer.c.user_id == timeline.c.user_id).order_by(
+        newer.c.timestamp.desc()).limit(1).offset(
+        current_app.config['TIMELINE_LENGTH']).as_scalar()
+    db.session.execute(timeline.delete().where(db.and_(
+        timeline.c.user_id.in_(user_ids), timeline.c.timestamp <= cutoff)))
+
+
+def add_post(post):
+    # the author sees their own post right away, followers get it from the
+    # job; the row is committed together with the (flushed) post by the caller
+    db.session.execute(timeline.insert().from_select(
+        ['user_id', 'post_id', 'timestamp'],
+        db.select([db.literal(post.user_id), db.literal(post.id),
+                   db.literal(post.timestamp, db.DateTime)]).where(
+            _not_in_timeline(post.user_id, post.id))))
+    _trim([post.user_id])
+
+
+def fan_out_post(post_id):
+    post = Post.query.get(post_id)
+    if post is None:
+        return
+    db.session.execute(timeline.insert().from_select(
+        ['user_id', 'post_id', 'timestamp'],
+        db.select([followers.c.follower_id, db.literal(post.id),
+                   db.literal(post.timestamp, db.DateTime)]).where(db.and_(
+            followers.c.followed_id == post.user_id,
+            _not_in_timeline(followers.c.follower_id, post.id)))))
+    _trim(db.select([followers.c.follower_id]).where(
+        followers.c.followed_id == post.user_id))
+    db.session.commit()
+
+
+def backfill(user, followed):
+    # copy the newest posts of a freshly followed user into the timeline
+    recent = db.select([db.literal(user.id), Post.id, Post.timestamp]).where(
+        db.and_(Post.user_id == followed.id,
+                _not_in_timeline(user.id, Post.id))).order_by(
+        Post.timestamp.desc()).limit(current_app.config['TIMELINE_LENGTH'])
+    db.session.execute(timeline.insert().from_select(
+        ['user_id', 'post_id', 'timestamp'], recent))
+    _trim([user.id])
+    db.session.commit()
+
+
+def prune(user, unfollowed):
+    db.session.execute(timeline.delete().where(db.and_(
+        timeline.c.user_id == user.id,
+        timeline.c.post_id.in_(db.select([Post.id]).where(
+            Post.user_id == unfollowed.id)))))
+    db.session.commit()
+
+
+def rebuild(user):
+    # recreate the timeline of a user from scratch out of followed_posts()
+    db.session.execute(timeline.delete().where(timeline.c.user_id == user.id))
+    recent = user.followed_posts().limit(
+        current_app.config['TIMELINE_LENGTH']).all()
+    if recent:
+        db.session.execute(timeline.insert(), [
+            {'user_id': user.id, 'post_id': post.id,
+             'timestamp': post.timestamp} for post in recent])
+    db.session.commit()
+
+
+def rebuild_all():
+    count = 0
+    for user in User.query.order_by(User.id):
+        rebuild(user)
+        count += 1
+    return count
@@ -1,17 +1,114 @@
+import hashlib
 import json
+import redis
 import requests
+from requests.adapters import HTTPAdapter
 from flask_babel import _
 from flask import current_app
+from app1.instrumentation import timed
 
+# texts sent in a single TranslateArray call, the texts travel in the url
+_BATCH_LIMIT = 25
+_TIMEOUT = 10
 
+# one pooled session per process, so the connection to the translator is
+# kept alive between requests instead of a new tls handshake every time
+_session = requests.Session()
+_session.mount('https://', HTTPAdapter(pool_connections=4, pool_maxsize=16))
+_session.mount('http://', HTTPAdapter(pool_connections=4, pool_maxsize=16))
 
-def translate(text, source_language, dest_language):
-    if 'MS_TRANSLATOR_KEY' not in current_app.config or \
-     not current_app.config['MS_TRANSLATOR_KEY']:
-        return _('Error: the translation  service is not configured.')
+
+def _key(text, source_language, dest_language):
+    return 'translation:{}:{}:{}'.format(
+        hashlib.sha1(text.encode('utf-8')).hexdigest(), source_language,
+        dest_language)
+
+
+def _cached(keys):
+    # the in-process cache first, whatever is missing there from redis
+    local = current_app.translation_cache
+    found = {}
+    for key in keys:
+        text = local.get(key)
+        if text is not None:
+            found[key] = text
+    missing = [key for key in keys if key not in found]
+    if missing and current_app.redis is not None:
+        try:
+            values = current_app.redis.mget(missing)
+        except redis.exceptions.RedisError:
+            values = []
+        for key, text in zip(missing, values):
+            if text is not None:
+                found[key] = text.decode('utf-8')
+                local.set(key, found[key])
+    return found
+
+
+def _store(translations):
+    local = current_app.translation_cache
+    for key, text in translations.items():
+        local.set(key, text)
+    if current_app.redis is not None and translations:
+        try:
+            pipe = current_app.redis.pipeline()
+            for key, text in translations.items():
+                pipe.setex(key, current_app.config['TRANSLATION_CACHE_TTL'], text)
+            pipe.execute()
+        except redis.exceptions.RedisError:
+            pass
+
+
+def _request(texts, source_language, dest_language):
+    # returns the translated texts, or None when the service failed
     auth = {'Ocp-Apim-Subscription-Key': current_app.config['MS_TRANSLATOR_KEY']}
-    r = requests.get('https://api.microsofttranslator.com/V2/Ajax.svc/Translate?text={}&from={}&to={}'.format(
-                text, source_language, dest_language), headers=auth)
+    url = current_app.config['MS_TRANSLATOR_URL']
+    try:
+        with timed('translate'):
+            if len(texts) == 1:
+                r = _session.get(url + '/Translate', params={
+                    'text': texts[0], 'from': source_language,
+                    'to': dest_language}, headers=auth, timeout=_TIMEOUT)
+            else:
+                r = _session.get(url + '/TranslateArray', params={
+                    'texts': json.dumps(texts), 'from': source_language,
+                    'to': dest_language}, headers=auth, timeout=_TIMEOUT)
+    except requests.RequestException:
+        return None
     if r.status_code != 200:
-        return _('Error: the translation service failed')
-    return json.loads(r.content.decode('utf-8-sig'))
\ No newline at end of file
+        return None
+    result = json.loads(r.content.decode('utf-8-sig'))
+    if len(texts) == 1:
+        return [result]
+    return [item['TranslatedText'] for item in result]
+
+
+def translate_batch(texts, source_language, dest_language):
+    # translations are cached by the hash of the text and the language pair,
+    # only the texts not seen before go to the translator, in as few calls
+    # as the batch limit allows
+    if 'MS_TRANSLATOR_KEY' not in current_app.config or \
+     not current_app.config['MS_TRANSLATOR_KEY']:
+        return [_('Error: the translation  service is not configured.')] * len(texts)
+    keys = [_key(text, source_language, dest_language) for text in texts]
+    found = _cached(set(keys))
+    missing = []
+    for text, key in zip(texts, keys):
+        if key not in found and text not in missing:
+            missing.append(text)
+    for i in range(0, len(missing), _BATCH_LIMIT):
+        chunk = missing[i:i + _BATCH_LIMIT]
+        translated = _request(chunk, source_language, dest_language)
+        if translated is None:
+            continue
+        translations = {_key(text, source_language, dest_language): result
+                        for text, result in zip(chunk, translated)}
+        _store(translations)
+        found.update(translations)
+    # failed translations are not cached, the next request tries again
+    return [found.get(key, _('Error: the translation service failed'))
+            for key in keys]
+
+
+def translate(text, source_language, dest_language):
+    return translate_batch([text], source_language, dest_language)[0]
@@ -0,0 +1,269 @@
+# load-test and benchmark harness for the main blueprint
+#
+# builds a synthetic social graph in a throwaway database, drives the main
+# pages through the flask test client and reports latency percentiles,
+# requests per second and SQL statements per request, for example:
+#
+#   python benchmark.py --users 2000 --posts 20000 --output results.json
+#   python benchmark.py --output new.json --compare results.json
+#
+# the login page is driven by a single thread, its req/s is the number of
+# logins per second one core sustains at the configured password hashing
+# cost, see --password-iterations
+import json
+import os
+import platform
+import random
+import subprocess
+from datetime import datetime, timedelta
+from time import perf_counter
+import click
+from sqlalchemy import event
+from sqlalchemy.engine.url import make_url
+from app1 import create_app, db, timeline, passwords
+from app1.models import User, Post, Message, followers
+from config import Config
+
+
+class BenchmarkConfig(Config):
+    TESTING = True
+    SECRET_KEY = 'benchmark'
+    WTF_CSRF_ENABLED = False
+    SQLALCHEMY_DATABASE_URI = 'sqlite://'
+    REDIS_URL = None
+    SEARCH_BACKEND = 'local'
+    SEARCH_INDEX_PATH = ':memory:'
+    FRAGMENT_CACHE = 'local'
+    # the activity of the simulated users is flushed once per run
+    LAST_SEEN_FLUSH_INTERVAL = 3600
+
+
+WORDS = ('the quick brown fox jumps over lazy dog flask python blog post '
+         'search timeline follow message hello world coffee morning night '
+         'music travel photo code review release bug fix').split()
+
+
+def _sentence(rng):
+    return ' '.join(rng.choice(WORDS) for _ in range(rng.randint(3, 15)))
+
+
+def generate(users, posts, messages, follow_exponent, seed):
+    # follow counts and targets follow a power law: a few accounts have most
+    # of the followers and most users follow only a handful of accounts
+    rng = random.Random(seed)
+    password_hash = passwords.hash_password('benchmark')
+    now = datetime.utcnow()
+    db.session.execute(User.__table__.insert(), [
+        {'id': i, 'username': 'user{}'.format(i),
+         'email': 'user{}@example.com'.format(i),
+         'password_hash': password_hash, 'last_seen': now,
+         'unread_message_count': 0}
+        for i in range(1, users + 1)])
+    weights = [1.0 / rank ** follow_exponent for rank in range(1, users + 1)]
+    edges = set()
+    for follower in range(1, users + 1):
+        count = min(users - 1, int(rng.paretovariate(1.2)) * 2)
+        for followed in rng.choices(range(1, users + 1), weights, k=count):
+            if followed != follower:
+                edges.add((follower, followed))
+    db.session.execute(followers.insert(), [
+        {'follower_id': a, 'followed_id': b} for a, b in sorted(edges)])
+    # popular users post more as well
+    authors = rng.choices(range(1, users + 1), weights, k=posts)
+    db.session.execute(Post.__table__.insert(), [
+        {'body': _sentence(rng), 'user_id': author, 'language': 'en',
+         'timestamp': now - timedelta(seconds=rng.randint(0, 30 * 86400))}
+        for author in authors])
+    db.session.execute(Message.__table__.insert(), [
+        {'sender_id': rng.randint(1, users), 'recipient_id': rng.randint(1, users),
+         'body': _sentence(rng),
+         'timestamp': now - timedelta(seconds=rng.randint(0, 30 * 86400))}
+        for _ in range(messages)])
+    db.session.commit()
+    User.repair_counters()
+    timeline.rebuild_all()
+    Post.reindex()
+    return len(edges)
+
+
+def percentile(samples, p):
+    ordered = sorted(samples)
+    index = max(0, int(round(p / 100.0 * len(ordered))) - 1)
+    return ordered[index]
+
+
+class Scenario(object):
+    # anonymous scenarios run without the session cookie of a logged in user
+    def __init__(self, name, method, url, data=None, anonymous=False):
+        self.name = name
+        self.method = method
+        self.url = url
+        self.data = data
+        self.anonymous = anonymous
+
+
+def scenarios(rng, users):
+    def user():
+        return 'user{}'.format(rng.randint(1, users))
+
+    return [
+        Scenario('index', 'GET', lambda: '/index'),
+        Scenario('explore', 'GET', lambda: '/explore'),
+        Scenario('user', 'GET', lambda: '/user/' + user()),
+        Scenario('user_popup', 'GET', lambda: '/user/{}/popup'.format(user())),
+        Scenario('search', 'GET',
+                 lambda: '/search?q=' + rng.choice(WORDS)),
+        Scenario('notifications', 'GET', lambda: '/notifications'),
+        Scenario('send_message', 'POST', lambda: '/send_message/' + user(),
+                 data=lambda: {'message': _sentence(rng)[:140]}),
+        Scenario('login', 'POST', lambda: '/auth/login',
+                 data=lambda: {'username': user(), 'password': 'benchmark'},
+                 anonymous=True),
+    ]
+
+
+def run(clients, scenario, requests, warmup):
+    statements = [0]
+
+    def count(*args):
+        statements[0] += 1
+
+    latencies = []
+    sql = []
+    for i in range(warmup + requests):
+        client = clients[i % len(clients)]
+        url = scenario.url()
+        data = scenario.data() if scenario.data else None
+        statements[0] = 0
+        event.listen(db.engine, 'before_cursor_execute', count)
+        start = perf_counter()
+        rv = client.open(url, method=scenario.method, data=data)
+        elapsed = perf_counter() - start
+        event.remove(db.engine, 'before_cursor_execute', count)
+        if rv.status_code >= 400:
+            raise click.ClickException('{} {} returned {}'.format(
+                scenario.method, url, rv.status_code))
+        if i >= warmup:
+            latencies.append(elapsed)
+            sql.append(statements[0])
+    return {
+        'requests': requests,
+        'p50_ms': percentile(latencies, 50) * 1000,
+        'p95_ms': percentile(latencies, 95) * 1000,
+        'p99_ms': percentile(latencies, 99) * 1000,
+        'requests_per_sec': requests / sum(latencies),
+        'sql_per_request': float(sum(sql)) / requests,
+    }
+
+
+def _git_commit():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', 'HEAD'], stderr=subprocess.DEVNULL,
+            cwd=os.path.dirname(os.path.abspath(__file__))).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+@click.command()
+@click.option('--users', default=500, help='Number of users to generate.')
+@click.option('--posts', default=5000, help='Number of posts to generate.')
+@click.option('--messages', default=2000, help='Number of private messages.')
+@click.option('--follow-exponent', default=1.1,
+              help='Exponent of the power law popularity of users.')
+@click.option('--requests', default=200, help='Measured requests per page.')
+@click.option('--warmup', default=10, help='Unmeasured requests per page.')
+@click.option('--clients', default=20, help='Distinct logged in users.')
+@click.option('--seed', default=1, help='Random seed, same seed same data.')
+@click.option('--database', default='sqlite://',
+              help='Database URL, an in-memory sqlite database by default.')
+@click.option('--drop', is_flag=True,
+              help='Allow dropping the tables of a database that is not an '
+                   'in-memory sqlite one.')
+@click.option('--password-iterations', type=int,
+              help='Work factor of the password hashes, the configured one '
+                   'by default.')
+@click.option('--only', multiple=True, help='Only run the named pages.')
+@click.option('--output', type=click.Path(), help='Write the results as JSON.')
+@click.option('--compare', type=click.Path(exists=True),
+              help='JSON results of a previous run to compare against.')
+def main(users, posts, messages, follow_exponent, requests, warmup, clients,
+         seed, database, drop, password_iterations, only, output, compare):
+    """Benchmark the main pages against a synthetic social graph."""
+    # every table of the database is dropped and recreated below
+    if database != 'sqlite://' and not drop:
+        raise click.ClickException('{} would be wiped, pass --drop if it is a '
+                                   'throwaway database'.format(database))
+    BenchmarkConfig.SQLALCHEMY_DATABASE_URI = database
+    if password_iterations:
+        BenchmarkConfig.PASSWORD_HASH_ITERATIONS = password_iterations
+    app = create_app(BenchmarkConfig)
+    app_context = app.app_context()
+    app_context.push()
+    db.drop_all()
+    db.create_all()
+    start = perf_counter()
+    follows = generate(users, posts, messages, follow_exponent, seed)
+    click.echo('Generated {} users, {} follows, {} posts and {} messages in '
+               '{:.1f}s'.format(users, follows, posts, messages,
+                                perf_counter() - start))
+
+    # requests take turns between a random sample of logged in users
+    rng = random.Random(seed)
+    logged_in = []
+    for id in rng.sample(range(1, users + 1), min(clients, users)):
+        client = app.test_client()
+        rv = client.post('/auth/login', data={'username': 'user{}'.format(id),
+                                              'password': 'benchmark'})
+        if rv.status_code != 302:
+            raise click.ClickException('Could not log in as user{}'.format(id))
+        logged_in.append(client)
+
+    results = {}
+    click.echo('{:<14}{:>10}{:>10}{:>10}{:>10}{:>8}'.format(
+        'page', 'p50 ms', 'p95 ms', 'p99 ms', 'req/s', 'sql'))
+    for scenario in scenarios(rng, users):
+        if only and scenario.name not in only:
+            continue
+        runners = [app.test_client(use_cookies=False)] \
+            if scenario.anonymous else logged_in
+        r = results[scenario.name] = run(runners, scenario, requests, warmup)
+        click.echo('{:<14}{:>10.2f}{:>10.2f}{:>10.2f}{:>10.0f}{:>8.1f}'.format(
+            scenario.name, r['p50_ms'], r['p95_ms'], r['p99_ms'],
+            r['requests_per_sec'], r['sql_per_request']))
+
+    if compare:
+        with open(compare) as f:
+            previous = json.load(f)['results']
+        click.echo('\nChange against {}'.format(compare))
+        for name, r in results.items():
+            if name in previous:
+                click.echo('{:<14}p50 {:+.1f}%  p99 {:+.1f}%  sql {:+.1f}'.format(
+                    name,
+                    100.0 * (r['p50_ms'] / previous[name]['p50_ms'] - 1),
+                    100.0 * (r['p99_ms'] / previous[name]['p99_ms'] - 1),
+                    r['sql_per_request'] - previous[name]['sql_per_request']))
+
+    if output:
+        with open(output, 'w') as f:
+            json.dump({
+                'commit': _git_commit(),
+                'timestamp': datetime.utcnow().isoformat() + 'Z',
+                'python': platform.python_version(),
+                # the repr of the url masks the password
+                'database': repr(make_url(
+                    app.config['SQLALCHEMY_DATABASE_URI'])),
+                'parameters': {'users': users, 'posts': posts,
+                               'messages': messages, 'follows': follows,
+                               'follow_exponent': follow_exponent,
+                               'requests': requests, 'warmup': warmup,
+                               'clients': clients, 'seed': seed,
+                               'password_hash': passwords.method()},
+                'results': results,
+            }, f, indent=4, sort_keys=True)
+    db.session.remove()
+    app_context.pop()
+
+
+if __name__ == '__main__':
+    main()
@@ -1,4 +1,3 @@
-
 import os
 from dotenv import load_dotenv
 
@@ -17,17 +16,131 @@ class Config(object):
 	MAIL_USE_TLS = os.environ.get('MAIL_USE_TLS') is not None
 	MAIL_USERNAME = os.environ.get("MAIL_USERNAME")
 	MAIL_PASSWORD = os.environ.get("MAIL_PASSWORD")
+	# mail is sent by MAIL_WORKERS threads per process, each holding an smtp
+	# connection open until it was idle for MAIL_IDLE_TIMEOUT seconds. Senders
+	# wait up to MAIL_QUEUE_TIMEOUT seconds when MAIL_QUEUE_SIZE messages are
+	# already waiting, failed sends are retried with exponential backoff
+	MAIL_WORKERS = int(os.environ.get('MAIL_WORKERS') or 2)
+	MAIL_QUEUE_SIZE = int(os.environ.get('MAIL_QUEUE_SIZE') or 100)
+	MAIL_QUEUE_TIMEOUT = float(os.environ.get('MAIL_QUEUE_TIMEOUT') or 5)
+	MAIL_IDLE_TIMEOUT = float(os.environ.get('MAIL_IDLE_TIMEOUT') or 30)
+	MAIL_SEND_RETRIES = int(os.environ.get('MAIL_SEND_RETRIES') or 3)
+	MAIL_RETRY_DELAY = float(os.environ.get('MAIL_RETRY_DELAY') or 1)
 	ADMINS = ['nikola@example.com']
 
 	POSTS_PER_PAGE = 10
+	USERS_PER_PAGE = 10
 
 	LANGUAGES = ['en', 'es']
 
 	# Microsoft translator API key
 	MS_TRANSLATOR_KEY = os.getenv('MS_TRANSLATOR_KEY')
+	MS_TRANSLATOR_URL = os.environ.get('MS_TRANSLATOR_URL') or \
+		'https://api.microsofttranslator.com/V2/Ajax.svc'
+	# translations are cached in redis for this many seconds, and the most
+	# recently used ones in the memory of each process as well
+	TRANSLATION_CACHE_TTL = int(os.environ.get('TRANSLATION_CACHE_TTL') or 7 * 86400)
+	TRANSLATION_CACHE_SIZE = int(os.environ.get('TRANSLATION_CACHE_SIZE') or 10000)
 
 	# Elasticsearch connection URL for the service
 	ELASTICSEARCH_URL = os.environ.get('ELASTICSEARCH_URL')
 
-	# Redis service config, if not specified we'll use local redis
-	REDIS_URL = os.environ.get('REDIS_URL') or 'redis://'
\ No newline at end of file
+	# search engine, 'elasticsearch' or 'local' for the built-in sqlite index
+	# stored at SEARCH_INDEX_PATH, which works without any external service
+	SEARCH_BACKEND = os.environ.get('SEARCH_BACKEND') or \
+		('elasticsearch' if ELASTICSEARCH_URL else 'local')
+	SEARCH_INDEX_PATH = os.environ.get('SEARCH_INDEX_PATH') or \
+		os.path.join(basedir, 'search.db')
+
+	# Redis service config. Setting REDIS_URL to None in a config class runs
+	# without redis: the background jobs run in the web process, the page
+	# fragments are cached in the memory of each process, which is only
+	# correct with a single process (tests, benchmarks), and the tokens and
+	# session users are not cached at all
+	REDIS_URL = os.environ.get('REDIS_URL') or 'redis://'
+
+	# rq queues of the background jobs, workers drain them in this order, and
+	# the queue of every job type, the others go to 'default'
+	TASK_QUEUES = ['high', 'default', 'low', 'exports']
+	TASK_ROUTES = {
+		'fan_out_post': 'high',
+		'flush_index_queue': 'high',
+		'detect_post_language': 'default',
+		'flush_last_seen': 'low',
+		'export_posts': 'exports',
+	}
+	# queues worked on by at most this many workers at a time, a slot taken
+	# by a worker that died is freed after TASK_LEASE seconds
+	TASK_CONCURRENCY = {'exports': 2}
+	TASK_LEASE = int(os.environ.get('TASK_LEASE') or 3600)
+	# seconds a job counts as waiting, identical jobs are not queued twice
+	TASK_PENDING_TTL = int(os.environ.get('TASK_PENDING_TTL') or 3600)
+
+	# maximum number of posts kept in the materialized home timeline of a user
+	TIMELINE_LENGTH = int(os.environ.get('TIMELINE_LENGTH') or 800)
+
+	# how often the recorded user activity is written to User.last_seen, in seconds
+	LAST_SEEN_FLUSH_INTERVAL = int(os.environ.get('LAST_SEEN_FLUSH_INTERVAL') or 60)
+
+	# number of index changes sent to elastic per bulk request, and how many
+	# times a failed bulk request is retried before the job gives up
+	SEARCH_BATCH_SIZE = int(os.environ.get('SEARCH_BATCH_SIZE') or 500)
+	SEARCH_INDEX_RETRIES = int(os.environ.get('SEARCH_INDEX_RETRIES') or 3)
+	# seconds until a flush of the queued index changes that failed runs again
+	SEARCH_FLUSH_RETRY_DELAY = int(os.environ.get('SEARCH_FLUSH_RETRY_DELAY') or 60)
+
+	# seconds between keepalive comments on idle notification streams, and
+	# after how many seconds a stream is closed for the browser to reconnect.
+	# Each open stream holds a worker (a thread or process with the sync
+	# servers) for that long
+	NOTIFICATION_KEEPALIVE = int(os.environ.get('NOTIFICATION_KEEPALIVE') or 15)
+	NOTIFICATION_STREAM_LIFETIME = int(os.environ.get('NOTIFICATION_STREAM_LIFETIME') or 60)
+
+	# requests slower than this many seconds are logged with a timing breakdown
+	SLOW_REQUEST_THRESHOLD = float(os.environ.get('SLOW_REQUEST_THRESHOLD') or 0.5)
+	# per-route latency histograms at /metrics, in the prometheus text format
+	METRICS_ENABLED = os.environ.get('METRICS_ENABLED') is not None
+
+	# posts read per query by the export task, and the minimum number of
+	# seconds between two progress updates of a running export
+	EXPORT_BATCH_SIZE = int(os.environ.get('EXPORT_BATCH_SIZE') or 1000)
+	EXPORT_PROGRESS_INTERVAL = float(os.environ.get('EXPORT_PROGRESS_INTERVAL') or 2)
+
+	# rendered posts and user popups are cached in redis, shared by all the
+	# processes, or in the memory of a single process; 'none' turns it off
+	FRAGMENT_CACHE = os.environ.get('FRAGMENT_CACHE') or \
+		('redis' if REDIS_URL else 'local')
+	FRAGMENT_CACHE_SIZE = int(os.environ.get('FRAGMENT_CACHE_SIZE') or 10000)
+	FRAGMENT_CACHE_TTL = int(os.environ.get('FRAGMENT_CACHE_TTL') or 86400)
+
+	# Cache-Control of the responses by endpoint, the pages are personal and
+	# are revalidated with their ETag on every visit
+	CACHE_CONTROL = {
+		'main.explore': 'private, no-cache',
+		'main.user': 'private, no-cache',
+		'api.get_user': 'private, no-cache',
+		'api.get_users': 'private, no-cache',
+		'api.get_followers': 'private, no-cache',
+		'api.get_follows': 'private, no-cache',
+	}
+
+	# lifetime of the api tokens, and how many token lookups each process
+	# keeps in memory in front of redis and the database (none without redis)
+	TOKEN_EXPIRES_IN = int(os.environ.get('TOKEN_EXPIRES_IN') or 3600)
+	TOKEN_CACHE_SIZE = int(os.environ.get('TOKEN_CACHE_SIZE') or 10000)
+
+	# users of the logged in sessions are kept for this many seconds, in the
+	# memory of each process and in redis (not at all without redis), changes
+	# to a user drop them
+	USER_CACHE_TTL = int(os.environ.get('USER_CACHE_TTL') or 30)
+	USER_CACHE_SIZE = int(os.environ.get('USER_CACHE_SIZE') or 10000)
+
+	# werkzeug hashing method and work factor (the iterations of the pbkdf2
+	# methods) of new password hashes, hashes made with other settings are
+	# replaced when their user logs in. With PASSWORD_HASH_PROCESSES set the
+	# hashing runs in a pool of that many processes, and at most
+	# PASSWORD_HASH_QUEUE hashes per process wait for it
+	PASSWORD_HASH_METHOD = os.environ.get('PASSWORD_HASH_METHOD') or 'pbkdf2:sha256'
+	PASSWORD_HASH_ITERATIONS = int(os.environ.get('PASSWORD_HASH_ITERATIONS') or 150000)
+	PASSWORD_HASH_PROCESSES = int(os.environ.get('PASSWORD_HASH_PROCESSES') or 0)
+	PASSWORD_HASH_QUEUE = int(os.environ.get('PASSWORD_HASH_QUEUE') or 4)
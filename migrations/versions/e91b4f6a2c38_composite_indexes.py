@@ -0,0 +1,53 @@
+"""followers primary key and composite indexes
+
+Revision ID: e91b4f6a2c38
+Revises: 5a7e0c3b9d12
+Create Date: 2026-10-18 20:21:37.604981
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'e91b4f6a2c38'
+down_revision = '5a7e0c3b9d12'
+branch_labels = None
+depends_on = None
+
+
+def _copy_followers(primary_key):
+    # the table is rebuilt as not every database can add a primary key in
+    # place, duplicated and incomplete rows are dropped on the way
+    columns = [
+        sa.Column('follower_id', sa.Integer(), nullable=not primary_key),
+        sa.Column('followed_id', sa.Integer(), nullable=not primary_key),
+        sa.ForeignKeyConstraint(['followed_id'], ['user.id'], ),
+        sa.ForeignKeyConstraint(['follower_id'], ['user.id'], )
+    ]
+    if primary_key:
+        columns.append(sa.PrimaryKeyConstraint('follower_id', 'followed_id'))
+    op.create_table('followers_copy', *columns)
+    op.execute('INSERT INTO followers_copy (follower_id, followed_id) '
+               'SELECT DISTINCT follower_id, followed_id FROM followers '
+               'WHERE follower_id IS NOT NULL AND followed_id IS NOT NULL')
+    op.drop_table('followers')
+    op.rename_table('followers_copy', 'followers')
+
+
+def upgrade():
+    _copy_followers(primary_key=True)
+    op.create_index('ix_followers_followed_id_follower_id', 'followers', ['followed_id', 'follower_id'], unique=False)
+    op.create_index('ix_message_recipient_id_timestamp', 'message', ['recipient_id', 'timestamp'], unique=False)
+    op.create_index('ix_notification_user_id_name', 'notification', ['user_id', 'name'], unique=False)
+    op.create_index('ix_notification_user_id_timestamp', 'notification', ['user_id', 'timestamp'], unique=False)
+    op.create_index('ix_post_user_id_timestamp', 'post', ['user_id', 'timestamp'], unique=False)
+
+
+def downgrade():
+    op.drop_index('ix_post_user_id_timestamp', table_name='post')
+    op.drop_index('ix_notification_user_id_timestamp', table_name='notification')
+    op.drop_index('ix_notification_user_id_name', table_name='notification')
+    op.drop_index('ix_message_recipient_id_timestamp', table_name='message')
+    op.drop_index('ix_followers_followed_id_follower_id', table_name='followers')
+    _copy_followers(primary_key=False)
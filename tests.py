@@ -1,13 +1,337 @@
+from collections import OrderedDict
 from datetime import datetime, timedelta
+from time import sleep, time
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import StreamRequestHandler, ThreadingTCPServer
+from threading import Event, Thread
+from urllib.parse import parse_qs, urlparse
+import base64
+import io
+import json
+import queue
 import unittest
-from app1 import db, create_app
-from app1.models import User, Post
+import redis
+import rq
+from elasticsearch.exceptions import TransportError
+from flask import template_rendered
+from sqlalchemy import event
+from app1 import db, create_app, models
+from app1.email import send_email
+from app1.models import User, Post, Message, Notification, followers
+from app1 import timeline, last_seen, language, jobs, search, fragments
+from app1.cache import TieredCache
+from app1.export import ThrottledProgress, write_posts
+from app1.pagination import paginate
+from app1.search import ElasticsearchBackend
 from config import Config
+try:
+    import fakeredis
+except ImportError:
+    fakeredis = None
 
 
 class TestConfig(Config):
     TESTING = True
     SQLALCHEMY_DATABASE_URI = 'sqlite://'
+    REDIS_URL = None
+    SECRET_KEY = 'test-key'
+    WTF_CSRF_ENABLED = False
+    SEARCH_INDEX_PATH = ':memory:'
+    FRAGMENT_CACHE = 'local'
+    PASSWORD_HASH_ITERATIONS = 1000
+
+
+class RecordingElasticsearch(object):
+    # stands in for the elasticsearch client, keeping the bulk requests
+    def __init__(self):
+        self.requests = []
+
+    def bulk(self, body):
+        self.requests.append(body)
+        return {'errors': False, 'items': []}
+
+
+class RecordingRedis(object):
+    # stands in for the redis client, keeping published messages and
+    # handing them out to pub/sub subscribers
+    def __init__(self):
+        self.published = []
+        self.values = {}
+
+    def hset(self, *args):
+        pass
+
+    def mget(self, keys):
+        return [self.values.get(key) for key in keys]
+
+    def setex(self, key, ttl, value):
+        self.values[key] = value.encode('utf-8')
+
+    def set(self, *args, **kwargs):
+        return False
+
+    def pipeline(self, transaction=True):
+        return self
+
+    def execute(self):
+        return []
+
+    def publish(self, channel, data):
+        self.published.append((channel, data))
+
+    def pubsub(self, **kwargs):
+        return RecordingPubSub(self)
+
+
+class RecordingPubSub(object):
+    def __init__(self, redis):
+        self.redis = redis
+        self.channels = []
+
+    def subscribe(self, channel):
+        self.channels.append(channel)
+
+    def get_message(self, timeout=None):
+        for channel, data in self.redis.published:
+            if channel in self.channels:
+                self.redis.published.remove((channel, data))
+                return {'type': 'message', 'channel': channel, 'data': data}
+
+    def close(self):
+        pass
+
+
+class StubTranslator(object):
+    # local http server answering like the translator service, every text is
+    # "translated" by prefixing it with the destination language
+    def __init__(self):
+        self.requests = []
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                url = urlparse(self.path)
+                args = parse_qs(url.query)
+                stub.requests.append((url.path, args))
+                if url.path.endswith('/TranslateArray'):
+                    result = [{'TranslatedText': '[{}] {}'.format(
+                        args['to'][0], text)}
+                        for text in json.loads(args['texts'][0])]
+                else:
+                    result = '[{}] {}'.format(args['to'][0], args['text'][0])
+                body = json.dumps(result).encode('utf-8-sig')
+                self.send_response(200)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = HTTPServer(('127.0.0.1', 0), Handler)
+        self.url = 'http://127.0.0.1:{}/V2/Ajax.svc'.format(
+            self.server.server_port)
+        Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+class MemoryRedis(object):
+    # stands in for the redis commands used by the job routing and the
+    # caches, keys with an expiration are dropped once it passed
+    def __init__(self):
+        self.data = {}
+        self.expires = {}
+        self.subscribers = []
+
+    def _get(self, key, default=None):
+        if key in self.expires and self.expires[key] <= time():
+            self.data.pop(key, None)
+            del self.expires[key]
+        return self.data.get(key, default)
+
+    def set(self, key, value, nx=False, ex=None):
+        if nx and self._get(key) is not None:
+            return None
+        self.data[key] = str(value).encode('utf-8')
+        self.expires.pop(key, None)
+        if ex:
+            self.expires[key] = time() + ex
+        return True
+
+    def get(self, key):
+        return self._get(key)
+
+    def mget(self, keys):
+        return [self._get(key) for key in keys]
+
+    def setex(self, key, ttl, value):
+        self.set(key, str(value), ex=ttl)
+
+    def incrby(self, key, amount):
+        value = int(self._get(key) or 0) + amount
+        self.data[key] = str(value).encode('utf-8')
+        return value
+
+    def delete(self, *keys):
+        for key in keys:
+            self.data.pop(key, None)
+
+    def hset(self, key, field, value):
+        self.data.setdefault(key, {})[field] = value
+
+    def rpush(self, key, *values):
+        self.data.setdefault(key, []).extend(
+            value.encode('utf-8') for value in values)
+
+    def lpush(self, key, *values):
+        for value in values:
+            self.data.setdefault(key, []).insert(0, value)
+
+    def lrange(self, key, start, end):
+        return self._get(key, [])[start:end + 1 if end != -1 else None]
+
+    def ltrim(self, key, start, end):
+        self.data[key] = self._get(key, [])[start:end + 1 if end != -1 else None]
+
+    def expire(self, key, seconds):
+        self.expires[key] = time() + seconds
+
+    def zadd(self, key, mapping):
+        self.data.setdefault(key, {}).update(mapping)
+
+    def zrem(self, key, member):
+        self._get(key, {}).pop(member, None)
+
+    def zremrangebyscore(self, key, min, max):
+        entries = self._get(key, {})
+        for member, score in list(entries.items()):
+            if float(min) <= score <= float(max):
+                del entries[member]
+
+    def zrank(self, key, member):
+        entries = self._get(key, {})
+        if member not in entries:
+            return None
+        return sorted(entries, key=lambda m: (entries[m], m)).index(member)
+
+    def pipeline(self, transaction=True):
+        return MemoryPipeline(self)
+
+    def publish(self, channel, data):
+        for pubsub in list(self.subscribers):
+            if channel in pubsub.channels:
+                pubsub.messages.put({'type': 'message', 'channel': channel,
+                                     'data': data.encode('utf-8')})
+
+    def pubsub(self, **kwargs):
+        pubsub = MemoryPubSub()
+        self.subscribers.append(pubsub)
+        return pubsub
+
+
+class MemoryPubSub(object):
+    def __init__(self):
+        self.channels = []
+        self.messages = queue.Queue()
+
+    def subscribe(self, channel):
+        self.channels.append(channel)
+
+    def get_message(self, timeout=None):
+        try:
+            return self.messages.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+
+class MemoryPipeline(object):
+    # commands are recorded and run on the MemoryRedis when executed
+    def __init__(self, redis):
+        self.redis = redis
+        self.commands = []
+
+    def __getattr__(self, name):
+        return lambda *args, **kwargs: self.commands.append(
+            (name, args, kwargs))
+
+    def execute(self):
+        return [getattr(self.redis, name)(*args, **kwargs)
+                for name, args, kwargs in self.commands]
+
+
+class RecordingQueue(object):
+    # stands in for an rq queue, keeping the jobs put into it
+    def __init__(self, name):
+        self.name = name
+        self.jobs = []
+        self.scheduled = []
+        self.fail = False
+
+    def enqueue(self, f, *args, **kwargs):
+        if self.fail:
+            raise redis.exceptions.ConnectionError('queue unavailable')
+        self.jobs.append((kwargs.pop('job_id'), f, args, kwargs))
+
+    def enqueue_in(self, delay, f, *args, **kwargs):
+        self.scheduled.append((delay, f, args))
+
+
+class StubSMTP(object):
+    # local smtp server keeping the messages it receives, the next `failures`
+    # messages are refused with a temporary error and while `hold` is clear
+    # it does not answer the end of a message
+    def __init__(self):
+        self.connections = 0
+        self.messages = []
+        self.failures = 0
+        self.hold = Event()
+        self.hold.set()
+        self.receiving = Event()
+        stub = self
+
+        class Handler(StreamRequestHandler):
+            def reply(self, line):
+                self.wfile.write(line.encode('ascii') + b'\r\n')
+
+            def handle(self):
+                stub.connections += 1
+                self.reply('220 stub')
+                while True:
+                    line = self.rfile.readline()
+                    if not line:
+                        return
+                    command = line[:4].upper()
+                    if command == b'DATA':
+                        self.reply('354 go ahead')
+                        data = []
+                        for line in iter(self.rfile.readline, b'.\r\n'):
+                            data.append(line)
+                        stub.receiving.set()
+                        stub.hold.wait()
+                        if stub.failures:
+                            stub.failures -= 1
+                            self.reply('451 try again later')
+                        else:
+                            stub.messages.append(b''.join(data))
+                            self.reply('250 queued')
+                    elif command == b'QUIT':
+                        self.reply('221 bye')
+                        return
+                    else:
+                        self.reply('250 ok')
+
+        self.server = ThreadingTCPServer(('127.0.0.1', 0), Handler)
+        self.server.daemon_threads = True
+        self.port = self.server.server_address[1]
+        Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def close(self):
+        self.hold.set()
+        self.server.shutdown()
+        self.server.server_close()
 
 
 class UserModelCase(unittest.TestCase):
@@ -28,6 +352,57 @@ class UserModelCase(unittest.TestCase):
         self.assertFalse(u.check_password('dog'))
         self.assertTrue(u.check_password('cat'))
 
+    def test_password_rehash(self):
+        u = User(username='susan', email='susan@example.com')
+        u.set_password('cat')
+        db.session.add(u)
+        db.session.commit()
+        self.assertTrue(u.password_hash.startswith('pbkdf2:sha256:1000$'))
+
+        # a wrong password leaves the old hash alone, logging in replaces it
+        # with one made with the current work factor
+        self.app.config['PASSWORD_HASH_ITERATIONS'] = 2000
+        old_hash = u.password_hash
+        self.assertFalse(u.check_password('dog'))
+        self.assertEqual(u.password_hash, old_hash)
+        rv = self.app.test_client().post('/auth/login', data={
+            'username': 'susan', 'password': 'cat'})
+        self.assertEqual(rv.status_code, 302)
+        db.session.expire_all()
+        u = User.query.filter_by(username='susan').first()
+        self.assertTrue(u.password_hash.startswith('pbkdf2:sha256:2000$'))
+        self.assertTrue(u.check_password('cat'))
+
+    def test_password_hashing_pool(self):
+        self.app.config['PASSWORD_HASH_PROCESSES'] = 1
+        u = User(username='susan')
+        u.set_password('cat')
+        self.assertTrue(u.password_hash.startswith('pbkdf2:sha256:1000$'))
+        self.assertFalse(u.check_password('dog'))
+        self.assertTrue(u.check_password('cat'))
+
+        # a new pool size replaces the pool, the app shuts it down
+        pool = self.app.password_pool
+        executor = pool.executor
+        self.app.config['PASSWORD_HASH_PROCESSES'] = 2
+        self.assertTrue(u.check_password('cat'))
+        self.assertIsNot(pool.executor, executor)
+        self.assertEqual(pool.processes, 2)
+        pool.shutdown()
+        self.assertIsNone(pool.executor)
+
+    def test_password_hash_methods(self):
+        # only the pbkdf2 methods take a number of iterations
+        self.app.config['PASSWORD_HASH_METHOD'] = 'sha256'
+        u = User(username='susan')
+        u.set_password('cat')
+        self.assertTrue(u.password_hash.startswith('sha256$'))
+        self.assertTrue(u.check_password('cat'))
+        self.assertTrue(u.password_hash.startswith('sha256$'))
+        self.app.config['PASSWORD_HASH_METHOD'] = 'pbkdf2:sha256'
+        self.assertTrue(u.check_password('cat'))
+        self.assertTrue(u.password_hash.startswith('pbkdf2:sha256:1000$'))
+
     def test_avatar(self):
         u = User(username='john', email='john@example.com')
         self.assertEqual(u.avatar(128), ('https://www.gravatar.com/avatar/'
@@ -57,6 +432,44 @@ class UserModelCase(unittest.TestCase):
         self.assertEqual(u1.follows.count(), 0)
         self.assertEqual(u2.followers.count(), 0)
 
+    def test_counters(self):
+        u1 = User(username='john', email='john@example.com')
+        u2 = User(username='susan', email='susan@example.com')
+        u3 = User(username='mary', email='mary@example.com')
+        db.session.add_all([u1, u2, u3])
+        db.session.commit()
+        u1.follow(u2)
+        u1.follow(u3)
+        u3.follow(u2)
+        p1 = Post(body='post from susan', author=u2)
+        p2 = Post(body='another post from susan', author=u2)
+        db.session.add_all([p1, p2])
+        db.session.commit()
+        self.assertEqual((u1.follows_count, u1.follower_count), (2, 0))
+        self.assertEqual((u2.follows_count, u2.follower_count), (0, 2))
+        self.assertEqual(u2.post_count, 2)
+
+        u1.unfollow(u2)
+        db.session.delete(p1)
+        db.session.commit()
+        self.assertEqual((u1.follows_count, u2.follower_count), (1, 1))
+        self.assertEqual(u2.post_count, 1)
+
+        # serializing a user runs no queries at all
+        with self.app.test_request_context():
+            with QueryCounter(db.engine) as counter:
+                data = u2.to_dict()
+        self.assertEqual(counter.count, 0)
+        self.assertEqual((data['post_count'], data['follower_count'],
+                          data['follows_count']), (1, 1, 0))
+
+        # counters that went wrong are recomputed from the tables
+        u2.post_count = 42
+        u3.follows_count = None
+        db.session.commit()
+        User.repair_counters()
+        self.assertEqual((u2.post_count, u3.follows_count), (1, 1))
+
     def test_follow_posts(self):
         # create four users
         u1 = User(username='john', email='john@example.com')
@@ -95,6 +508,1109 @@ class UserModelCase(unittest.TestCase):
         self.assertEqual(f3, [p3, p4])
         self.assertEqual(f4, [p4])
 
+    def test_timeline(self):
+        u1 = User(username='john', email='john@example.com')
+        u2 = User(username='susan', email='susan@example.com')
+        u3 = User(username='mary', email='mary@example.com')
+        db.session.add_all([u1, u2, u3])
+        now = datetime.utcnow()
+        p1 = Post(body="post from susan", author=u2,
+                  timestamp=now + timedelta(seconds=1))
+        p2 = Post(body="post from mary", author=u3,
+                  timestamp=now + timedelta(seconds=2))
+        db.session.add_all([p1, p2])
+        db.session.commit()
+
+        # following backfills the timeline with existing posts
+        u1.follow(u2)
+        u1.follow(u3)
+        db.session.commit()
+        timeline.backfill(u1, u2)
+        timeline.backfill(u1, u3)
+        self.assertEqual(u1.timeline_posts().all(), [p2, p1])
+
+        # new posts are pushed to the author and the followers
+        p3 = Post(body="another post from susan", author=u2,
+                  timestamp=now + timedelta(seconds=3))
+        db.session.add(p3)
+        db.session.flush()
+        timeline.add_post(p3)
+        db.session.commit()
+        timeline.fan_out_post(p3.id)
+        timeline.fan_out_post(p3.id)
+        self.assertEqual(u1.timeline_posts().all(), [p3, p2, p1])
+        self.assertEqual(u2.timeline_posts().all(), [p3])
+
+        # unfollowing prunes the timeline
+        u1.unfollow(u3)
+        db.session.commit()
+        timeline.prune(u1, u3)
+        self.assertEqual(u1.timeline_posts().all(), [p3, p1])
+
+        # timelines are bounded, and a rebuild matches followed_posts()
+        self.app.config['TIMELINE_LENGTH'] = 1
+        timeline.fan_out_post(p1.id)
+        self.assertEqual(u1.timeline_posts().all(), [p3])
+        self.app.config['TIMELINE_LENGTH'] = 10
+        timeline.rebuild(u1)
+        self.assertEqual(u1.timeline_posts().all(), u1.followed_posts().all())
+
+    def test_search_changes_are_bulk_indexed(self):
+        es = RecordingElasticsearch()
+        self.app.search = ElasticsearchBackend(es)
+        self.app.config['SEARCH_BATCH_SIZE'] = 2
+        u = User(username='john', email='john@example.com')
+        posts = [Post(body='post {}'.format(i), author=u) for i in range(3)]
+        db.session.add_all(posts)
+        db.session.commit()
+        # one bulk request per batch, not one request per post and field
+        self.assertEqual([len(body) for body in es.requests], [4, 2])
+        docs = es.requests[0][1::2] + es.requests[1][1::2]
+        self.assertEqual(sorted(doc['body'] for doc in docs),
+                         ['post 0', 'post 1', 'post 2'])
+
+        db.session.delete(posts[0])
+        db.session.commit()
+        self.assertEqual(es.requests[-1], [{'delete': {
+            '_index': 'post', '_type': 'post', '_id': posts[0].id}}])
+
+        # without a queue an unavailable service is tried once and the
+        # commit still succeeds
+        class UnavailableElasticsearch(object):
+            calls = 0
+
+            def bulk(self, body):
+                self.calls += 1
+                raise TransportError('N/A', 'unavailable')
+
+        es = UnavailableElasticsearch()
+        self.app.search = ElasticsearchBackend(es)
+        with self.assertLogs(self.app.logger, 'ERROR'):
+            db.session.delete(posts[1])
+            db.session.commit()
+        self.assertEqual(es.calls, 1)
+        self.assertIsNone(Post.query.get(posts[1].id))
+
+    def test_local_search(self):
+        u = User(username='john', email='john@example.com')
+        p1 = Post(body='the quick brown fox', author=u)
+        p2 = Post(body='a lazy brown dog', author=u)
+        p3 = Post(body='brown brown brown fox fox', author=u)
+        p4 = Post(body='nothing to see here', author=u)
+        db.session.add_all([p1, p2, p3, p4])
+        db.session.commit()
+
+        # best matches first, paginated like the elastic results
+        posts, total = Post.search('brown fox', 1, 2)
+        self.assertEqual(total, 3)
+        self.assertEqual(posts.all(), [p3, p1])
+        posts, total = Post.search('brown fox', 2, 2)
+        self.assertEqual(posts.all(), [p2])
+
+        # the index follows updates and deletes
+        p4.body = 'a fox after all'
+        db.session.delete(p3)
+        db.session.commit()
+        posts, total = Post.search('fox', 1, 10)
+        self.assertEqual(total, 2)
+        self.assertEqual(set(posts.all()), {p1, p4})
+        self.assertEqual(Post.search('"(*', 1, 10)[1], 0)
+
+    def test_reindex(self):
+        u = User(username='john', email='john@example.com')
+        db.session.add_all([Post(body='post {}'.format(i), author=u)
+                            for i in range(5)])
+        db.session.commit()
+        es = RecordingElasticsearch()
+        self.app.search = ElasticsearchBackend(es)
+        reported = []
+        indexed = Post.reindex(batch_size=2, workers=2,
+                               progress=lambda n, id: reported.append((n, id)))
+        self.assertEqual(indexed, 5)
+        self.assertEqual([len(body) for body in es.requests], [4, 4, 2])
+        self.assertEqual(reported, [(2, 2), (4, 4), (5, 5)])
+
+        # resuming only indexes what comes after the given id
+        es.requests = []
+        self.assertEqual(Post.reindex(batch_size=2, start_id=4), 1)
+        self.assertEqual(es.requests[0][0]['index']['_id'], 5)
+
+    def test_notifications_are_published(self):
+        self.app.redis = RecordingRedis()
+        u = User(username='john', email='john@example.com')
+        db.session.add(u)
+        db.session.commit()
+        u.add_notification('unread_message_count', 3)
+        db.session.rollback()
+        self.assertEqual(self.app.redis.published, [])
+        u.add_notification('unread_message_count', 4)
+        db.session.commit()
+        (channel, data), = self.app.redis.published
+        self.assertEqual(channel, 'notifications:{}'.format(u.id))
+        self.assertEqual(json.loads(data)['data'], 4)
+
+    def test_keyset_pagination(self):
+        u = User(username='john', email='john@example.com')
+        db.session.add(u)
+        now = datetime.utcnow()
+        # pairs of posts share a timestamp so the id has to break the tie
+        posts = [Post(body='post {}'.format(i), author=u,
+                      timestamp=now + timedelta(seconds=i // 2))
+                 for i in range(25)]
+        db.session.add_all(posts)
+        db.session.commit()
+        expected = Post.query.order_by(Post.timestamp.desc(),
+                                       Post.id.desc()).all()
+
+        # walk forward through all the pages
+        pages = []
+        cursor = None
+        while True:
+            page = paginate(Post.query, (Post.timestamp, Post.id), 10, cursor)
+            pages.append(page)
+            if page.next_cursor is None:
+                break
+            cursor = page.next_cursor
+        self.assertEqual([len(page.items) for page in pages], [10, 10, 5])
+        self.assertEqual(sum([page.items for page in pages], []), expected)
+        self.assertIsNone(pages[0].prev_cursor)
+
+        # and back again from the last page
+        page = paginate(Post.query, (Post.timestamp, Post.id), 10,
+                        pages[2].prev_cursor)
+        self.assertEqual(page.items, pages[1].items)
+        page = paginate(Post.query, (Post.timestamp, Post.id), 10,
+                        page.prev_cursor)
+        self.assertEqual(page.items, pages[0].items)
+        self.assertIsNone(page.prev_cursor)
+
+        # garbage cursors fall back to the first page
+        page = paginate(Post.query, (Post.timestamp, Post.id), 10, 'garbage!')
+        self.assertEqual(page.items, pages[0].items)
+
+
+    def test_export_posts(self):
+        u1 = User(username='john', email='john@example.com')
+        u2 = User(username='susan', email='susan@example.com')
+        db.session.add_all([u1, u2])
+        now = datetime.utcnow()
+        db.session.add_all([Post(body='post {}'.format(i),
+                                 author=u1 if i % 3 else u2,
+                                 timestamp=now + timedelta(seconds=i))
+                            for i in range(25)])
+        db.session.commit()
+
+        reported = []
+        progress = ThrottledProgress(reported.append, u1.posts.count(), 0)
+        batches = []
+        f = io.StringIO()
+        done = write_posts(u1, f, batch_size=4,
+                           progress=lambda n: (batches.append(n),
+                                               progress.update(n)))
+        exported = json.loads(f.getvalue())['posts']
+        self.assertEqual(done, 16)
+        self.assertEqual([post['body'] for post in exported],
+                         [p.body for p in u1.posts.order_by(Post.id)])
+        self.assertEqual(batches, [4, 8, 12, 16])
+        # 100 is only reported once the export has been delivered
+        self.assertEqual(reported, [25, 50, 75, 99])
+
+        # updates closer together than the interval are dropped
+        reported = []
+        progress = ThrottledProgress(reported.append, 16, 3600)
+        for n in batches:
+            progress.update(n)
+        self.assertEqual(reported, [])
+
+        # a user without posts still gets a valid document
+        u3 = User(username='mary', email='mary@example.com')
+        db.session.add(u3)
+        db.session.commit()
+        f = io.StringIO()
+        self.assertEqual(write_posts(u3, f), 0)
+        self.assertEqual(json.loads(f.getvalue()), {'posts': []})
+
+
+    def test_language_detection(self):
+        u = User(username='john', email='john@example.com')
+        db.session.add(u)
+        english = 'This is a post that is written in the English language.'
+        spanish = 'Este es un mensaje que está escrito en el idioma español.'
+        posts = [Post(body=english, author=u),
+                 Post(body=spanish, author=u, language=''),
+                 Post(body='xq zk', author=u),
+                 Post(body=spanish, author=u, language='en'),
+                 Post(body=english, author=u)]
+        db.session.add_all(posts)
+        db.session.commit()
+        ids = [p.id for p in posts]
+
+        self.assertEqual(language.detect_post_language(ids[0]), 'en')
+        reported = []
+        done = language.backfill(batch_size=2, processes=2,
+                                 progress=lambda *args: reported.append(args))
+        self.assertEqual(done, 3)
+        self.assertEqual(reported, [(2, ids[2]), (3, ids[4])])
+        db.session.expire_all()
+        # posts with a language are left alone, undetectable ones become ''
+        self.assertEqual([Post.query.get(id).language for id in ids],
+                         ['en', 'es', '', 'en', 'en'])
+
+
+def redis_caches(app):
+    # the tiered caches only keep values with redis, so that every process
+    # hears about the invalidations
+    client = MemoryRedis()
+    app.token_cache = TieredCache(client, 'token',
+                                  app.config['TOKEN_CACHE_SIZE'])
+    app.user_cache = TieredCache(client, 'user', app.config['USER_CACHE_SIZE'],
+                                 app.config['USER_CACHE_TTL'])
+    return client
+
+
+class QueryCounter(object):
+    # counts the SQL statements sent to the database inside a with block
+    def __init__(self, engine):
+        self.engine = engine
+        self.statements = []
+
+    @property
+    def count(self):
+        return len(self.statements)
+
+    def _on_execute(self, conn, cursor, statement, *args):
+        self.statements.append(statement)
+
+    def __enter__(self):
+        event.listen(self.engine, 'before_cursor_execute', self._on_execute)
+        return self
+
+    def __exit__(self, *args):
+        event.remove(self.engine, 'before_cursor_execute', self._on_execute)
+
+
+def query_plan(query):
+    # sqlite's EXPLAIN QUERY PLAN for a query or core statement
+    statement = getattr(query, 'statement', query)
+    compiled = statement.compile(db.engine)
+    cursor = db.session.connection().connection.cursor()
+    cursor.execute('EXPLAIN QUERY PLAN ' + str(compiled),
+                   [compiled.params[name] for name in compiled.positiontup])
+    return ' / '.join(row[-1] for row in cursor.fetchall())
+
+
+class QueryPlanCase(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app(TestConfig)
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+        self.user = User(username='john', email='john@example.com')
+        db.session.add(self.user)
+        db.session.commit()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def assertUsesIndex(self, query, index):
+        plan = query_plan(query)
+        self.assertIn('USING', plan)
+        self.assertIn(index, plan)
+
+    def test_followers(self):
+        # the composite primary key is the automatic index of the table
+        self.assertUsesIndex(self.user.follows.filter(
+            followers.c.followed_id == 2), 'sqlite_autoindex_followers_1')
+        self.assertUsesIndex(self.user.followers,
+                             'ix_followers_followed_id_follower_id')
+        self.assertUsesIndex(self.user.followed_posts(),
+                             'sqlite_autoindex_followers_1')
+
+    def test_posts(self):
+        self.assertUsesIndex(self.user.posts.order_by(Post.timestamp.desc()),
+                             'ix_post_user_id_timestamp')
+
+    def test_messages(self):
+        self.assertUsesIndex(self.user.messages_received.order_by(
+            Message.timestamp.desc()), 'ix_message_recipient_id_timestamp')
+
+    def test_notifications(self):
+        self.assertUsesIndex(self.user.notifications.filter(
+            Notification.timestamp > 1.5).order_by(
+            Notification.timestamp.asc()), 'ix_notification_user_id_timestamp')
+        self.assertUsesIndex(self.user.notifications.filter_by(
+            name='unread_message_count'), 'ix_notification_user_id_name')
+
+
+class PageRenderCase(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app(TestConfig)
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+        self.client = self.app.test_client()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def login(self, username):
+        u = User(username=username, email=username + '@example.com')
+        u.set_password('cat')
+        db.session.add(u)
+        db.session.commit()
+        self.client.post('/auth/login', data={'username': username,
+                                              'password': 'cat'})
+        return u
+
+    def add_posts(self, count, follower):
+        # every post gets its own author, the worst case for lazy loading
+        first = User.query.count()
+        for i in range(first, first + count):
+            author = User(username='author{}'.format(i),
+                          email='author{}@example.com'.format(i))
+            db.session.add(Post(body='post {}'.format(i), author=author))
+            follower.follow(author)
+        db.session.commit()
+        for author in follower.follows:
+            timeline.backfill(follower, author)
+
+    def count_queries(self, url):
+        # drop the identity map and the cached users so every page starts
+        # from a cold session
+        db.session.remove()
+        self.app.user_cache.local.clear()
+        with QueryCounter(db.engine) as counter:
+            rv = self.client.get(url)
+        self.assertEqual(rv.status_code, 200)
+        return counter.count
+
+    def test_post_lists_load_authors_in_bulk(self):
+        # the profiled user has posts too, and the search (local backend)
+        # finds the posts of every author. Without the fragment cache every
+        # page renders the authors of its posts
+        self.app.fragments = None
+        urls = ['/index', '/explore', '/user/john', '/search?q=post']
+
+        def add_posts(count):
+            u = User.query.filter_by(username='john').first()
+            self.add_posts(count, u)
+            db.session.add_all([Post(body='post by john', author=u)
+                                for i in range(count)])
+            db.session.commit()
+            Post.reindex(workers=1)
+
+        self.login('john')
+        # no last_seen flush in the middle of the measurements
+        last_seen._next_flush[0] = time() + 3600
+        add_posts(2)
+        few = [self.count_queries(url) for url in urls]
+        add_posts(8)
+        many = [self.count_queries(url) for url in urls]
+        self.assertEqual(few, many)
+
+    def test_notification_stream(self):
+        u = self.login('john')
+        # without redis the client is told to fall back to polling
+        self.assertEqual(self.client.get('/notifications/stream').status_code,
+                         204)
+
+        self.app.redis = RecordingRedis()
+        u.add_notification('unread_message_count', 1)
+        db.session.commit()
+        self.app.redis.published = []
+        rv = self.client.get('/notifications/stream', buffered=False)
+        self.assertEqual(rv.mimetype, 'text/event-stream')
+        events = iter(rv.response)
+        # the backlog comes from the database, then events are pushed
+        self.assertIn('"data": 1', next(events).decode())
+        u = User.query.get(u.id)
+        u.add_notification('unread_message_count', 2)
+        db.session.commit()
+        with QueryCounter(db.engine) as counter:
+            self.assertIn('"data": 2', next(events).decode())
+        self.assertEqual(counter.count, 0)
+        rv.close()
+
+        # the stream ends after its lifetime, a reconnect gets only what it
+        # missed and an idle stream keeps the id of the reconnect
+        self.app.config['NOTIFICATION_STREAM_LIFETIME'] = 0
+        since = u.notifications.first().timestamp
+        rv = self.client.get('/notifications/stream',
+                             headers={'Last-Event-ID': str(since - 1)})
+        events = rv.get_data(as_text=True).split('\n\n')
+        self.assertIn('"data": 2', events[0])
+        self.assertEqual(events[1:], [''])
+        rv = self.client.get('/notifications/stream',
+                             headers={'Last-Event-ID': str(since)})
+        self.assertEqual(rv.get_data(as_text=True),
+                         'id: {}\n\n'.format(since))
+
+    def test_unread_message_counter(self):
+        self.login('john')
+        susan = User(username='susan', email='susan@example.com')
+        susan.set_password('dog')
+        db.session.add(susan)
+        db.session.commit()
+        for i in range(3):
+            with QueryCounter(db.engine) as counter:
+                self.client.post('/send_message/susan',
+                                 data={'message': 'hi {}'.format(i)})
+            # sending never counts the inbox of the recipient
+            self.assertFalse([s for s in counter.statements
+                              if 'count(' in s.lower()])
+        susan = User.query.filter_by(username='susan').first()
+        self.assertEqual(susan.new_messages(), 3)
+        self.assertEqual(susan.notifications.first().get_data(), 3)
+
+        self.client.get('/auth/logout')
+        self.client.post('/auth/login', data={'username': 'susan',
+                                              'password': 'dog'})
+        self.client.get('/messages')
+        db.session.expire_all()
+        self.assertEqual(User.query.get(susan.id).new_messages(), 0)
+
+    def test_server_timing(self):
+        self.login('john')
+        rv = self.client.get('/explore')
+        timing = dict(entry.split(';', 1)[0:2] for entry in
+                      rv.headers['Server-Timing'].split(', '))
+        self.assertIn('sql', timing)
+        self.assertIn('template', timing)
+        self.assertIn('total', timing)
+
+    def test_slow_requests_and_metrics(self):
+        self.login('john')
+        self.app.config['SLOW_REQUEST_THRESHOLD'] = 0
+        with self.assertLogs(self.app.logger, 'WARNING') as logs:
+            self.client.get('/explore')
+        self.assertIn('Slow request GET /explore', logs.output[0])
+        with self.assertLogs(self.app.logger, 'WARNING'):
+            self.assertEqual(self.client.get('/no/such/page').status_code, 404)
+        metrics = self.app.metrics.render()
+        self.assertIn('{endpoint="<unmatched>",method="GET",status="404"} 1',
+                      metrics)
+        self.assertIn('microblog_request_duration_seconds_count'
+                      '{endpoint="main.explore",method="GET",status="200"} 1',
+                      metrics)
+
+    def test_last_seen_is_coalesced(self):
+        u = self.login('john')
+        last_seen._next_flush[0] = time() + 3600
+        before = u.last_seen
+        with QueryCounter(db.engine) as counter:
+            for i in range(5):
+                self.client.get('/notifications')
+        self.assertFalse([s for s in counter.statements
+                          if s.startswith('UPDATE user')])
+        self.assertEqual(last_seen.flush_last_seen(), 1)
+        self.assertEqual(last_seen.flush_last_seen(), 0)
+        db.session.expire_all()
+        self.assertGreater(User.query.get(u.id).last_seen, before)
+
+    def test_translations_are_cached_and_batched(self):
+        translator = StubTranslator()
+        self.addCleanup(translator.close)
+        self.app.config['MS_TRANSLATOR_KEY'] = 'key'
+        self.app.config['MS_TRANSLATOR_URL'] = translator.url
+        u = self.login('john')
+        posts = [Post(body='hello', author=u, language='en'),
+                 Post(body='world', author=u, language='en'),
+                 Post(body='hola', author=u, language='es'),
+                 Post(body='hello', author=u, language='en')]
+        db.session.add_all(posts)
+        db.session.commit()
+
+        rv = self.client.post('/translate', data={
+            'text': 'hello', 'source_language': 'en', 'dest_language': 'de'})
+        self.assertEqual(json.loads(rv.data)['text'], '[de] hello')
+        # a repeated translation is served from the cache
+        rv = self.client.post('/translate', data={
+            'text': 'hello', 'source_language': 'en', 'dest_language': 'de'})
+        self.assertEqual(json.loads(rv.data)['text'], '[de] hello')
+        self.assertEqual(len(translator.requests), 1)
+
+        # one call per source language, only for the texts not cached yet
+        rv = self.client.post('/translate_batch', data=json.dumps({
+            'posts': [p.id for p in posts], 'dest_language': 'de'}),
+            content_type='application/json')
+        translations = json.loads(rv.data)['translations']
+        self.assertEqual([translations[str(p.id)] for p in posts],
+                         ['[de] hello', '[de] world', '[de] hola',
+                          '[de] hello'])
+        self.assertEqual(sorted(path for path, args in translator.requests[1:]),
+                         ['/V2/Ajax.svc/Translate', '/V2/Ajax.svc/Translate'])
+
+        # other processes find the translations in redis
+        self.app.redis = RecordingRedis()
+        self.client.post('/translate_batch', data=json.dumps({
+            'posts': [p.id for p in posts], 'dest_language': 'fr'}),
+            content_type='application/json')
+        self.assertEqual(sorted(path for path, args in translator.requests[3:]),
+                         ['/V2/Ajax.svc/Translate', '/V2/Ajax.svc/TranslateArray'])
+        self.app.translation_cache.clear()
+        rv = self.client.post('/translate', data={
+            'text': 'world', 'source_language': 'en', 'dest_language': 'fr'})
+        self.assertEqual(json.loads(rv.data)['text'], '[fr] world')
+        self.assertEqual(len(translator.requests), 5)
+
+        # malformed requests and more posts than a page are refused
+        for data in ['[1, 2]', '{"posts": 1}', '{}', 'nope',
+                     json.dumps({'posts': list(range(
+                         self.app.config['POSTS_PER_PAGE'] + 1))}),
+                     json.dumps({'posts': [1], 'dest_language': 1})]:
+            rv = self.client.post('/translate_batch', data=data,
+                                  content_type='application/json')
+            self.assertEqual(rv.status_code, 400)
+        self.assertEqual(len(translator.requests), 5)
+
+    def rendered_templates(self, url):
+        names = []
+
+        def record(sender, template, context, **extra):
+            names.append(template.name)
+        template_rendered.connect(record, self.app)
+        try:
+            self.assertEqual(self.client.get(url).status_code, 200)
+        finally:
+            template_rendered.disconnect(record, self.app)
+        return names
+
+    def test_fragment_cache(self):
+        u = self.login('john')
+        self.add_posts(3, u)
+        self.assertEqual(self.rendered_templates('/explore').count(
+            'main/_post.html'), 3)
+        self.assertEqual(self.rendered_templates('/explore').count(
+            'main/_post.html'), 0)
+
+        # a changed post and the posts of a renamed author are rendered again
+        post = Post.query.order_by(Post.id).first()
+        post.body = 'changed'
+        db.session.commit()
+        self.assertEqual(self.rendered_templates('/explore').count(
+            'main/_post.html'), 1)
+        self.assertIn(b'changed', self.client.get('/explore').data)
+        post.author.username = 'renamed'
+        db.session.commit()
+        self.assertEqual(self.rendered_templates('/explore').count(
+            'main/_post.html'), 1)
+        self.assertIn(b'renamed', self.client.get('/explore').data)
+        # other changes to the author keep the posts
+        post.author.unread_message_count = 5
+        post.author.get_token()
+        db.session.commit()
+        self.assertEqual(self.rendered_templates('/explore').count(
+            'main/_post.html'), 0)
+
+        # popups depend on the user and on who is looking at them
+        url = '/user/renamed/popup'
+        self.assertEqual(self.rendered_templates(url), ['main/user_popup.html'])
+        self.assertEqual(self.rendered_templates(url), [])
+        self.client.get('/unfollow/renamed')
+        self.assertEqual(self.rendered_templates(url), ['main/user_popup.html'])
+        self.assertIn(b'Follow', self.client.get(url).data)
+
+    def test_redis_fragment_versions_expire(self):
+        cache = fragments.RedisFragmentCache(MemoryRedis(), 0.05)
+        self.assertEqual(cache.versions(['user:1', 'post:2']), [0, 0])
+        cache.bump(['user:1', 'post:2'])
+        first = cache.versions(['user:1', 'post:2'])
+        self.assertNotIn(0, first)
+        self.assertNotEqual(first[0], first[1])
+        cache.bump(['user:1'])
+        self.assertNotIn(cache.versions(['user:1'])[0], first)
+        sleep(0.1)
+        self.assertEqual(cache.versions(['user:1', 'post:2']), [0, 0])
+
+    def test_avatar_digest_is_memoized(self):
+        # a 50 post page by 5 authors, rendered without the fragment cache
+        self.app.fragments = None
+        self.app.config['POSTS_PER_PAGE'] = 50
+        self.login('john')
+        authors = [User(username='author{}'.format(i),
+                        email='author{}@example.com'.format(i))
+                   for i in range(5)]
+        now = datetime.utcnow()
+        db.session.add_all([Post(body='post {}'.format(i),
+                                 author=authors[i % 5],
+                                 timestamp=now - timedelta(seconds=i))
+                            for i in range(50)])
+        db.session.commit()
+        digests = []
+        real_md5 = models.md5
+
+        def md5(data):
+            digests.append(data)
+            return real_md5(data)
+        models.md5 = md5
+        try:
+            self.assertEqual(self.client.get('/explore').status_code, 200)
+        finally:
+            models.md5 = real_md5
+        self.assertEqual(len(digests), 5)
+
+        # a new email gets a new avatar
+        author = authors[0]
+        old = author.avatar(70)
+        author.email = 'new@example.com'
+        self.assertNotEqual(author.avatar(70), old)
+        self.assertIn(real_md5(b'new@example.com').hexdigest(),
+                      author.avatar(70))
+
+    def test_conditional_get(self):
+        u = self.login('john')
+        self.add_posts(3, u)
+        for url in ['/explore', '/user/author1']:
+            rv = self.client.get(url)
+            etag = rv.headers['ETag']
+            self.assertEqual(rv.headers['Cache-Control'], 'private, no-cache')
+            # an unchanged page is neither queried for posts nor rendered
+            db.session.remove()
+            with QueryCounter(db.engine) as counter:
+                rv = self.client.get(url, headers={'If-None-Match': etag})
+            self.assertEqual(rv.status_code, 304)
+            self.assertEqual(rv.headers['ETag'], etag)
+            self.assertFalse([s for s in counter.statements
+                              if 'FROM post' in s and 'max(' not in s])
+
+        # a new post, a renamed author or a new message change the pages
+        etags = [self.client.get(url).headers['ETag']
+                 for url in ['/explore', '/user/author1']]
+        author = User.query.filter_by(username='author1').first()
+        db.session.add(Post(body='new post', author=author))
+        db.session.commit()
+        for url, etag in zip(['/explore', '/user/author1'], etags):
+            self.assertEqual(self.client.get(
+                url, headers={'If-None-Match': etag}).status_code, 200)
+        etag = self.client.get('/explore').headers['ETag']
+        self.client.post('/send_message/john', data={'message': 'hi'})
+        self.assertEqual(self.client.get(
+            '/explore', headers={'If-None-Match': etag}).status_code, 200)
+
+        # the language detected for a post adds its translate link
+        post = Post.query.filter_by(body='new post').first()
+        etag = self.client.get('/explore').headers['ETag']
+        language.detect_post_language(post.id)
+        self.assertEqual(self.client.get(
+            '/explore', headers={'If-None-Match': etag}).status_code, 200)
+
+        # last_seen is shown on the user page but not in the post lists
+        etags = [self.client.get(url).headers['ETag']
+                 for url in ['/explore', '/user/author1']]
+        user = User.__table__
+        db.session.execute(user.update().where(user.c.id == author.id).values(
+            last_seen=datetime.utcnow() + timedelta(seconds=1)))
+        db.session.commit()
+        self.assertEqual([self.client.get(url, headers={
+            'If-None-Match': etag}).status_code for url, etag in zip(
+                ['/explore', '/user/author1'], etags)], [304, 200])
+
+    def test_session_user_is_cached(self):
+        client = redis_caches(self.app)
+        id = self.login('john').id
+        self.client.get('/notifications')
+        db.session.remove()
+        with QueryCounter(db.engine) as counter:
+            self.assertEqual(self.client.get('/notifications').status_code, 200)
+        self.assertFalse([s for s in counter.statements if 'FROM user' in s])
+
+        # credentials are not cached, the cached user loads them when needed
+        values = json.loads(client.get('user:{}'.format(id)).decode())
+        self.assertEqual(values['username'], 'john')
+        for column in ['password_hash', 'token', 'token_expiration']:
+            self.assertNotIn(column, values)
+        u = models.load_user(str(id))
+        self.assertNotIn('password_hash', u.__dict__)
+        self.assertTrue(u.check_password('cat'))
+        db.session.remove()
+
+        # profile edits and password resets go through the session and drop
+        # the cached user
+        self.client.post('/edit_profile', data={'username': 'johnny',
+                                                'about_me': 'hi'})
+        db.session.remove()
+        self.assertIn(b'johnny', self.client.get('/explore').data)
+        u = User.query.get(id)
+        u.set_password('dog')
+        db.session.commit()
+        db.session.remove()
+        with QueryCounter(db.engine) as counter:
+            self.client.get('/notifications')
+        self.assertTrue([s for s in counter.statements if 'FROM user' in s])
+        self.assertTrue(User.query.get(id).check_password('dog'))
+
+
+class APICase(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app(TestConfig)
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+        self.client = self.app.test_client()
+        self.users = [User(username='user{}'.format(i),
+                           email='user{}@example.com'.format(i))
+                      for i in range(25)]
+        db.session.add_all(self.users)
+        db.session.commit()
+        for user in self.users[1:]:
+            user.follow(self.users[0])
+        self.users[0].set_password('cat')
+        db.session.commit()
+        self.token = self.get_token('user0', 'cat')
+        self.headers = {'Authorization': 'Bearer ' + self.token}
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def get_token(self, username, password):
+        rv = self.client.post('/api/tokens', headers={
+            'Authorization': 'Basic ' + base64.b64encode('{}:{}'.format(
+                username, password).encode('utf-8')).decode('utf-8')})
+        return json.loads(rv.data)['token'] if rv.status_code == 200 else None
+
+    def get(self, url, headers=None):
+        rv = self.client.get(url, headers=dict(self.headers, **(headers or {})))
+        return rv, json.loads(rv.data) if rv.status_code == 200 else None
+
+    def walk(self, url):
+        items = []
+        while url:
+            rv, data = self.get(url)
+            self.assertEqual(rv.status_code, 200)
+            items.extend(item['id'] for item in data['items'])
+            url = data['_links']['next']
+        return items
+
+    def test_get_user(self):
+        rv, data = self.get('/api/users/1')
+        self.assertEqual(data['username'], 'user0')
+        self.assertEqual(data['follower_count'], 24)
+        self.assertEqual(data['_links']['followers'], '/api/users/1/followers')
+        self.assertEqual(self.get('/api/users/100')[0].status_code, 404)
+
+    def test_collections(self):
+        ids = [u.id for u in self.users]
+        self.assertEqual(self.walk('/api/users?per_page=7'), ids)
+        self.assertEqual(self.walk('/api/users/1/followers?per_page=10'),
+                         ids[1:])
+        self.assertEqual(self.walk('/api/users/2/followed'), [ids[0]])
+
+        # and back from the last page
+        rv, data = self.get('/api/users?per_page=10')
+        rv, data = self.get(data['_links']['next'])
+        rv, data = self.get(data['_links']['prev'])
+        self.assertEqual([item['id'] for item in data['items']], ids[:10])
+        self.assertIsNone(data['_links']['prev'])
+
+        # page sizes out of range are clamped to 1..100
+        for per_page, size in [(-5, 1), (0, 1), (500, 25)]:
+            rv, data = self.get('/api/users?per_page={}'.format(per_page))
+            self.assertEqual(rv.status_code, 200)
+            self.assertEqual(len(data['items']), size)
+            self.assertEqual(data['_meta']['per_page'], max(1, min(per_page,
+                                                                   100)))
+
+        # the number of queries does not grow with the page size
+        counts = []
+        for per_page in (2, 20):
+            db.session.remove()
+            with QueryCounter(db.engine) as counter:
+                self.get('/api/users/1/followers?per_page={}'.format(per_page))
+            counts.append(counter.count)
+        self.assertEqual(counts[0], counts[1])
+
+    def test_conditional_get(self):
+        for url in ['/api/users', '/api/users/1', '/api/users/1/followers']:
+            rv, data = self.get(url)
+            etag = rv.headers['ETag']
+            self.assertEqual(rv.headers['Cache-Control'], 'private, no-cache')
+            self.assertEqual(self.get(url, headers={
+                'If-None-Match': etag})[0].status_code, 304)
+        self.users[5].unfollow(self.users[0])
+        db.session.commit()
+        self.assertEqual(self.get('/api/users/1/followers', headers={
+            'If-None-Match': etag})[0].status_code, 200)
+
+    def test_tokens_without_redis(self):
+        # a revocation by another process is not heard of, so tokens are not
+        # kept in the memory of the process
+        self.assertEqual(self.get('/api/users/1')[0].status_code, 200)
+        db.session.execute(User.__table__.update().values(
+            token_expiration=datetime.utcnow() - timedelta(seconds=1)))
+        db.session.commit()
+        self.assertEqual(self.get('/api/users/1')[0].status_code, 401)
+
+    def test_tokens(self):
+        redis_caches(self.app)
+        self.assertIsNone(self.get_token('user0', 'dog'))
+        self.headers = {}
+        self.assertEqual(self.get('/api/users')[0].status_code, 401)
+        self.headers = {'Authorization': 'Bearer nope'}
+        self.assertEqual(self.get('/api/users')[0].status_code, 401)
+
+        # the same token is handed out again while it is valid, and once it
+        # has been seen it is resolved without the database
+        self.assertEqual(self.get_token('user0', 'cat'), self.token)
+        self.headers = {'Authorization': 'Bearer ' + self.token}
+        self.get('/api/users/1')
+        db.session.remove()
+        with QueryCounter(db.engine) as counter:
+            self.assertEqual(self.get('/api/users/1')[0].status_code, 200)
+        self.assertFalse([s for s in counter.statements if 'WHERE user.token' in s])
+
+        # revoked tokens are dropped from the cache right away
+        rv = self.client.delete('/api/tokens', headers=self.headers)
+        self.assertEqual(rv.status_code, 204)
+        self.assertEqual(self.get('/api/users/1')[0].status_code, 401)
+
+        # as are the tokens replaced by a new one
+        self.token = self.get_token('user0', 'cat')
+        self.headers = {'Authorization': 'Bearer ' + self.token}
+        self.assertEqual(self.get('/api/users/1')[0].status_code, 200)
+        user = User.query.get(1)
+        user.token_expiration = datetime.utcnow()
+        user.get_token()
+        db.session.commit()
+        self.assertEqual(self.get('/api/users/1')[0].status_code, 401)
+        self.headers = {'Authorization': 'Bearer ' + user.token}
+        self.assertEqual(self.get('/api/users/1')[0].status_code, 200)
+
+
+class MailCase(unittest.TestCase):
+    def setUp(self):
+        self.smtp = StubSMTP()
+
+        class MailConfig(TestConfig):
+            MAIL_SERVER = '127.0.0.1'
+            MAIL_PORT = self.smtp.port
+            MAIL_SUPPRESS_SEND = False
+            MAIL_WORKERS = 1
+            MAIL_QUEUE_SIZE = 1
+            MAIL_QUEUE_TIMEOUT = 0
+            MAIL_RETRY_DELAY = 0
+
+        self.app = create_app(MailConfig)
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+
+    def tearDown(self):
+        self.app_context.pop()
+        self.smtp.close()
+
+    def send(self, subject):
+        return send_email(subject, sender='admin@example.com',
+                          recipients=['susan@example.com'],
+                          text_body='text', html_body='<p>html</p>')
+
+    def test_messages_share_a_connection(self):
+        self.app.config['MAIL_QUEUE_TIMEOUT'] = 5
+        for i in range(5):
+            self.assertTrue(self.send('message {}'.format(i)))
+        self.app.mail_sender.join()
+        self.assertEqual(len(self.smtp.messages), 5)
+        self.assertIn(b'Subject: message 4', self.smtp.messages[4])
+        self.assertEqual(self.smtp.connections, 1)
+        self.assertEqual(self.app.metrics.mail['sent'][0], 5)
+        self.assertIn('microblog_mail_messages_total{outcome="sent"} 5',
+                      self.app.metrics.render())
+
+    def test_failed_sends_are_retried(self):
+        self.smtp.failures = 2
+        self.send('hello')
+        self.app.mail_sender.join()
+        self.assertEqual(len(self.smtp.messages), 1)
+        self.assertEqual(self.app.metrics.mail['sent'][:2], [1, 2])
+
+        # given up after MAIL_SEND_RETRIES more attempts
+        self.smtp.failures = 10
+        self.send('hello again')
+        self.app.mail_sender.join()
+        self.assertEqual(len(self.smtp.messages), 1)
+        self.assertEqual(self.app.metrics.mail['failed'][:2], [1, 3])
+
+    def test_full_queue_pushes_back(self):
+        # the worker is stuck on the first message, the second one fills
+        # the queue and the third does not fit anymore
+        self.smtp.hold.clear()
+        self.assertTrue(self.send('first'))
+        self.assertTrue(self.smtp.receiving.wait(5))
+        self.assertTrue(self.send('second'))
+        self.assertFalse(self.send('third'))
+        self.smtp.hold.set()
+        self.app.mail_sender.join()
+        self.assertEqual(len(self.smtp.messages), 2)
+        self.assertEqual(self.app.metrics.mail['dropped'][0], 1)
+
+
+
+class JobsCase(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app(TestConfig)
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+        self.app.redis = MemoryRedis()
+        self.app.task_queues = OrderedDict(
+            (name, RecordingQueue(name)) for name in TestConfig.TASK_QUEUES)
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def queued(self, queue):
+        return [(f, args) for job_id, f, args, kwargs
+                in self.app.task_queues[queue].jobs]
+
+    def test_jobs_are_routed(self):
+        jobs.enqueue(timeline.fan_out_post, 1)
+        jobs.enqueue(language.detect_post_language, 1)
+        jobs.submit('some_other_job', 'x')
+        u = User(username='susan', email='susan@example.com')
+        db.session.add(u)
+        db.session.commit()
+        task = u.launch_task('export_posts', 'Exporting posts...')
+        self.assertEqual(self.queued('high'),
+                         [('app1.main.tasks.fan_out_post', (1,))])
+        self.assertEqual(self.queued('default'), [
+            ('app1.main.tasks.detect_post_language', (1,)),
+            ('app1.main.tasks.some_other_job', ('x',))])
+        self.assertEqual(self.queued('exports'),
+                         [('app1.main.tasks.export_posts', (u.id,))])
+        self.assertEqual(task.id, self.app.task_queues['exports'].jobs[0][0])
+
+    def test_pending_jobs_are_not_duplicated(self):
+        first = jobs.enqueue(timeline.fan_out_post, 1)
+        self.assertEqual(jobs.enqueue(timeline.fan_out_post, 1), first)
+        self.assertNotEqual(jobs.enqueue(timeline.fan_out_post, 2), first)
+        self.assertEqual(len(self.queued('high')), 2)
+
+        u = User(username='susan', email='susan@example.com')
+        db.session.add(u)
+        db.session.commit()
+        task = u.launch_task('export_posts', 'Exporting posts...')
+        db.session.commit()
+        self.assertIs(u.launch_task('export_posts', 'Exporting posts...'), task)
+        self.assertEqual(len(self.queued('exports')), 1)
+
+        # once a worker started the job an identical one is queued again
+        self.app.redis.delete(jobs._pending_key('fan_out_post', (1,), {}))
+        self.assertNotEqual(jobs.enqueue(timeline.fan_out_post, 1), first)
+        self.assertEqual(len(self.queued('high')), 3)
+
+    def test_failed_enqueue_is_not_pending(self):
+        self.app.task_queues['default'].fail = True
+        self.assertIsNone(jobs.submit('some_other_job'))
+        self.app.task_queues['default'].fail = False
+        self.assertIsNotNone(jobs.submit('some_other_job'))
+        self.assertEqual(self.queued('default'),
+                         [('app1.main.tasks.some_other_job', ())])
+
+    def test_failed_export_is_reported(self):
+        u = User(username='susan', email='susan@example.com')
+        u.set_password('cat')
+        db.session.add(u)
+        db.session.commit()
+        client = self.app.test_client()
+        client.post('/auth/login', data={'username': 'susan',
+                                         'password': 'cat'})
+
+        def flashes():
+            with client.session_transaction() as session:
+                return [message for category, message
+                        in session.pop('_flashes', [])]
+
+        self.app.task_queues['exports'].fail = True
+        client.get('/export_posts')
+        self.assertEqual(flashes(), ['The export could not be started, '
+                                     'please try again later'])
+        self.assertIsNone(u.get_task_in_progress('export_posts'))
+        self.app.task_queues['exports'].fail = False
+        client.get('/export_posts')
+        self.assertEqual(flashes(), [])
+        self.assertIsNotNone(u.get_task_in_progress('export_posts'))
+
+    def test_failed_index_flush_is_retried(self):
+        class UnavailableElasticsearch(object):
+            def bulk(self, body):
+                raise TransportError('N/A', 'unavailable')
+
+        self.app.search = ElasticsearchBackend(UnavailableElasticsearch())
+        self.app.config['SEARCH_INDEX_RETRIES'] = 0
+        change = {'index': 'post', 'id': 1, 'action': 'delete'}
+        self.app.redis.rpush('search:pending', json.dumps(change))
+        with self.assertRaises(TransportError):
+            search.flush_index_queue()
+        # the change is still queued and a new flush is on its way
+        self.assertEqual(self.app.redis.lrange('search:pending', 0, -1),
+                         [json.dumps(change).encode('utf-8')])
+        self.assertEqual(self.app.task_queues['high'].scheduled, [
+            (timedelta(seconds=60), 'app1.main.tasks.flush_index_queue', ())])
+
+    def test_concurrency_limit(self):
+        r = MemoryRedis()
+        self.assertTrue(jobs.acquire_slot(r, 'microblog-exports', 'w1', 2, 60))
+        self.assertTrue(jobs.acquire_slot(r, 'microblog-exports', 'w2', 2, 60))
+        self.assertFalse(jobs.acquire_slot(r, 'microblog-exports', 'w3', 2, 60))
+        self.assertTrue(jobs.acquire_slot(r, 'microblog-low', 'w3', 2, 60))
+        # taking the slot again (the next dequeue) keeps the worker's place
+        self.assertTrue(jobs.acquire_slot(r, 'microblog-exports', 'w2', 2, 60))
+        jobs.release_slot(r, 'microblog-exports', 'w1')
+        self.assertTrue(jobs.acquire_slot(r, 'microblog-exports', 'w3', 2, 60))
+
+        # the slot of a worker that died runs out with its lease
+        self.assertTrue(jobs.acquire_slot(r, 'backup', 'w4', 1, 0.05))
+        self.assertFalse(jobs.acquire_slot(r, 'backup', 'w5', 1, 60))
+        sleep(0.1)
+        self.assertTrue(jobs.acquire_slot(r, 'backup', 'e', 1, 60))
+
+    @unittest.skipUnless(fakeredis, 'fakeredis is not installed')
+    def test_worker(self):
+        # the rq worker of the requirements, with the overrides of its
+        # dequeue, against an in-process redis server
+        r = fakeredis.FakeStrictRedis()
+        high, exports = [rq.Queue('microblog-' + name, connection=r)
+                         for name in ['high', 'exports']]
+        job = high.enqueue('tests.double', 1)
+        r.set(jobs._pending_key('double', (1,), {}), job.id)
+        for i in range(2):
+            exports.enqueue('tests.double', i)
+        # the jobs run in the worker process like with rq's SimpleWorker, a
+        # forked work horse would not share the in-process server
+        class Worker(jobs.Worker):
+            def fork_work_horse(self, job, queue):
+                self.perform_job(job, queue)
+
+            def monitor_work_horse(self, job, queue):
+                pass
+
+        worker = Worker([high, exports], connection=r,
+                        limits={'microblog-exports': 1}, lease=60)
+
+        # another worker holds the only slot of the exports, which are left
+        # in their queue
+        self.assertTrue(jobs.acquire_slot(r, 'microblog-exports', 'w', 1, 60))
+        worker.work(burst=True, logging_level='WARNING')
+        self.assertEqual((high.count, exports.count), (0, 2))
+        self.assertEqual(job.latest_result().return_value, 2)
+        self.assertIsNone(r.get(jobs._pending_key('double', (1,), {})))
+
+        jobs.release_slot(r, 'microblog-exports', 'w')
+        worker.work(burst=True, logging_level='WARNING')
+        self.assertEqual(exports.count, 0)
+        self.assertEqual(r.zcard('microblog-running:microblog-exports'), 0)
+
+
+def double(n):
+    # job run by the rq worker of JobsCase.test_worker
+    return 2 * n
+
 
 if __name__ == '__main__':
     unittest.main(verbosity=2)
\ No newline at end of file